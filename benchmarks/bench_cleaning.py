@@ -0,0 +1,42 @@
+# Benchmark of the cleaning() engines on a synthetic ClinVar-like table
+# Usage: python benchmarks/bench_cleaning.py --rows 200000
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "scripts"))
+from data_processing.cleaner import cleaning
+from helper import profiling
+from synthetic import synthetic_clinvar
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    # Only the cleaning itself is timed
+    profiling.configure(enable=False)
+    df = synthetic_clinvar(args.rows)
+    timings = {}
+    outputs = {}
+    for engine in ["python", "polars"]:
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            outputs[engine] = cleaning(df.copy(), "cancermama_clinvarmain", engine=engine)
+            times.append(time.perf_counter() - start)
+        timings[engine] = min(times)
+        print(f"{engine:>7}: {timings[engine]:.3f} s (best of {args.repeats}, {args.rows} rows)")
+
+    pd.testing.assert_frame_equal(outputs["python"], outputs["polars"])
+    print(f"Outputs are identical, speedup: {timings['python'] / timings['polars']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Benchmark suite of the pipeline stages on synthetic data, fully offline
+# Usage: python benchmarks/run_benchmarks.py --scale small medium
+#        python benchmarks/run_benchmarks.py --compare benchmarks/results/old.json benchmarks/results/new.json
+import sys
+import time
+import json
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "scripts"))
+from data_processing.cleaner import cleaning, compare_and_drop_duplicates, parse_dataframe, wide_upgenevsrep
+from feature_selection.selector import mutual_information, select_vars
+from model_training.optimizer import UMAPHDBSCANOptimizer
+from model_training.cross_validation import CrossValidator
+from helper import profiling
+from synthetic import (synthetic_clinvar, synthetic_upgenevsrep, synthetic_categorical, synthetic_correlation,
+                       synthetic_embedding_input, synthetic_classification)
+
+results_dir = Path(__file__).resolve().parent / "results"
+
+# Rows of the generated tables, columns of the select_vars matrix, rows given to UMAP and rows
+# of the classifier cross-validation per scale
+scales = {
+    "small": {"rows": 10000, "columns": 200, "umap_rows": 1000, "cv_rows": 2000},
+    "medium": {"rows": 100000, "columns": 500, "umap_rows": 3000, "cv_rows": 10000},
+    "large": {"rows": 500000, "columns": 1000, "umap_rows": 10000, "cv_rows": 50000},
+}
+
+
+def cases(scale):
+
+    # (name, setup, run) triples, setup builds the input once outside the timed region
+    size = scales[scale]
+    rows = size["rows"]
+
+    def cleaned_with_duplicates():
+        df = cleaning(synthetic_clinvar(rows), "cancermama_clinvarmain")
+        return df.assign(**{f"{col}_copy": df[col] for col in df.columns[:3]})
+
+    def optimizer_trial(data):
+        # A new optimizer every time so the embedding cache does not hide the UMAP fit
+        params = {"n_neighbors": 15, "min_samples": 10, "min_cluster_size": 20}
+        return UMAPHDBSCANOptimizer(data, scoring="sampled").evaluate(params)
+
+    def cross_validation(data):
+        # 5 folds of an XGBoost and a random forest candidate, pool start-up included
+        candidates = {"xgb": ("xgboost", {"n_estimators": 100, "max_depth": 4}),
+                      "rf": ("random_forest", {"n_estimators": 100})}
+        with CrossValidator(*data, n_splits=5) as validator:
+            return validator.evaluate(candidates)
+
+    return [
+        ("cleaning", lambda: synthetic_clinvar(rows),
+         lambda df: cleaning(df.copy(), "cancermama_clinvarmain")),
+        ("compare_and_drop_duplicates", cleaned_with_duplicates, compare_and_drop_duplicates),
+        ("parse_dataframe", lambda: synthetic_upgenevsrep(rows), parse_dataframe),
+        ("wide_upgenevsrep", lambda: parse_dataframe(synthetic_upgenevsrep(rows)),
+         lambda df: wide_upgenevsrep(df.copy())),
+        ("wide_upgenevsrep_sparse", lambda: parse_dataframe(synthetic_upgenevsrep(rows)),
+         lambda df: wide_upgenevsrep(df.copy(), sparse=True)),
+        ("mutual_information", lambda: synthetic_categorical(rows), mutual_information),
+        ("select_vars", lambda: synthetic_correlation(size["columns"]), select_vars),
+        ("optimizer_trial", lambda: synthetic_embedding_input(size["umap_rows"]), optimizer_trial),
+        ("cross_validation", lambda: synthetic_classification(size["cv_rows"]), cross_validation),
+    ]
+
+
+def measure(run, data, repeats):
+
+    # Best wall time of the repeats and the largest RSS growth above the starting RSS
+    seconds, peak_mb = [], []
+    for _ in range(repeats):
+        with profiling.PeakMemory() as memory:
+            start = time.perf_counter()
+            run(data)
+            seconds.append(time.perf_counter() - start)
+        peak_mb.append((memory.peak_rss - memory.start_rss) / 2 ** 20)
+    return min(seconds), max(peak_mb)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_suite(scale_names, repeats=3, only=None):
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeats": repeats,
+        "results": [],
+    }
+    for scale in scale_names:
+        for name, setup, run in cases(scale):
+            if only and name not in only:
+                continue
+            seconds, peak_mb = measure(run, setup(), repeats)
+            report["results"].append({"case": name, "scale": scale, "seconds": seconds, "peak_mb": peak_mb})
+            print(f"{scale:>6} {name:<28} {seconds:9.3f} s {peak_mb:9.1f} MB")
+    return report
+
+
+def compare_reports(old, new, threshold=1.2):
+
+    # Time ratio new / old of every case in both reports, ratios above threshold are regressions
+    old_times = {(r["case"], r["scale"]): r["seconds"] for r in old["results"]}
+    regressions = []
+    print(f"{old['commit']} -> {new['commit']}")
+    for r in new["results"]:
+        key = (r["case"], r["scale"])
+        if key not in old_times:
+            continue
+        ratio = r["seconds"] / old_times[key]
+        flag = "REGRESSION" if ratio > threshold else ""
+        print(f"{r['scale']:>6} {r['case']:<28} {old_times[key]:9.3f} s -> {r['seconds']:9.3f} s {ratio:6.2f}x {flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", nargs="+", default=["small"], choices=list(scales))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--only", nargs="+", help="names of the cases to run")
+    parser.add_argument("--output", type=Path, help="report path, benchmarks/results/<time>_<commit>.json by default")
+    parser.add_argument("--compare", nargs=2, type=Path, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = (json.loads(path.read_text()) for path in args.compare)
+        sys.exit(1 if compare_reports(old, new, args.threshold) else 0)
+
+    # The stage log would add its own overhead to every timed call
+    profiling.configure(enable=False)
+    report = run_suite(args.scale, args.repeats, args.only)
+    output = args.output or results_dir / f"{datetime.now():%Y%m%d_%H%M%S}_{report['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=1))
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
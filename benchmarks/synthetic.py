@@ -0,0 +1,112 @@
+# Synthetic inputs for the benchmarks, generated offline from a seed
+import sys
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "scripts"))
+from data_processing.cleaner import dict_reviewStatus_to_map, origin_dict
+
+
+def synthetic_clinvar(n_rows, seed=2024):
+
+    rng = np.random.default_rng(seed)
+    review_status = list(dict_reviewStatus_to_map) + ["unmapped status"]
+    origins = list(origin_dict) + ["rare origin"]
+    kinds = ["A>G", "C>T", "del", "dup", "delins", "G>A", "ins"]
+
+    review_html = [f"<b>Review</b><small>based on: {review_status[i]}</small>"
+                   if i < len(review_status) - 1 else "<b>Review</b>"
+                   for i in rng.integers(0, len(review_status), n_rows)]
+
+    hgvs = []
+    for _ in range(n_rows):
+        n_items = rng.integers(0, 4)
+        items = [[f"NM_{rng.integers(1, 999999):06d}.{rng.integers(1, 9)}:c.{rng.integers(1, 9999)}"
+                  f"{kinds[rng.integers(0, len(kinds))]}", "NP_000050.3"] for _ in range(n_items)]
+        hgvs.append(json.dumps(items))
+
+    df = pd.DataFrame({
+        "snpId": rng.integers(1, 10**8, n_rows),
+        "origName": [f"NM_{i:06d}.4(BRCA2):c.{i}A>G" for i in rng.integers(1, 10**6, n_rows)],
+        "reviewStatus": review_html,
+        "_jsonHgvsTable": hgvs,
+        "origin": rng.choice(origins, n_rows),
+        "Classification": rng.choice(["PG", "LP", "VUS", "LB", "B"], n_rows),
+        "lastEval": rng.choice(["2020-01-01", "2021-06-01"], n_rows),
+        "constant": "GRCh38",
+        "mostly_null": np.where(rng.random(n_rows) < 0.9, None, "value"),
+    })
+    return df
+
+
+def synthetic_upgenevsrep(n_rows, seed=2024, n_genes=None):
+
+    # Raw UP.geneVsrepList table: gene in column 4, ">kind|position" items in column 7
+    rng = np.random.default_rng(seed)
+    n_genes = n_genes or max(1, n_rows // 5)
+    kinds = ["LINE", "SINE", "LTR", "DNA", "Simple_repeat", "Low_complexity", "Satellite"]
+    to_parse = []
+    for _ in range(n_rows):
+        n_items = rng.integers(1, 8)
+        to_parse.append("".join(f">{kinds[rng.integers(0, len(kinds))]}|{rng.integers(1, 5000)}"
+                                for _ in range(n_items)))
+    return pd.DataFrame({
+        0: rng.integers(1, 10**6, n_rows),
+        1: "chr1",
+        2: rng.integers(1, 10**8, n_rows),
+        3: rng.integers(1, 10**8, n_rows),
+        4: [f"GENE{i}" for i in rng.integers(0, n_genes, n_rows)],
+        5: 0,
+        6: rng.choice(["+", "-"], n_rows),
+        7: to_parse,
+    })
+
+
+def synthetic_categorical(n_rows, n_cols=30, seed=2024):
+
+    # Cleaned-like nominal table, some columns are noisy copies of others so they are associated
+    rng = np.random.default_rng(seed)
+    data = {}
+    for j in range(n_cols):
+        if j % 3 == 2:
+            source = data[f"var_{j - 1}"]
+            noise = rng.random(n_rows) < 0.2
+            data[f"var_{j}"] = np.where(noise, rng.integers(0, 5, n_rows).astype(str), source)
+        else:
+            data[f"var_{j}"] = rng.integers(0, rng.integers(2, 12), n_rows).astype(str)
+    return pd.DataFrame(data)
+
+
+def synthetic_correlation(n_cols, seed=2024):
+
+    # Symmetric association matrix in [0, 1] with a unit diagonal, the input of select_vars
+    rng = np.random.default_rng(seed)
+    values = rng.random((n_cols, n_cols)) ** 4
+    values = np.triu(values, 1)
+    values = values + values.T + np.eye(n_cols)
+    names = [f"var_{j}" for j in range(n_cols)]
+    return pd.DataFrame(values, index=names, columns=names)
+
+
+def synthetic_embedding_input(n_rows, n_features=20, n_centers=6, seed=2024):
+
+    # Gaussian blobs standing in for the wide repeat table given to UMAPHDBSCANOptimizer
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=10, size=(n_centers, n_features))
+    labels = rng.integers(0, n_centers, n_rows)
+    return centers[labels] + rng.normal(size=(n_rows, n_features))
+
+
+def synthetic_classification(n_rows, n_categorical=6, n_numeric=6, seed=2024):
+
+    # Merged table stand-in for the classifiers: categorical and scaled numeric features, binary bin_class
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame({f"cat_{j}": pd.Categorical(rng.choice([f"level_{k}" for k in range(3 + 4 * j)], n_rows))
+                      for j in range(n_categorical)})
+    for j in range(n_numeric):
+        X[f"num_{j}"] = rng.normal(size=n_rows)
+    signal = X["num_0"] + (X["cat_0"].cat.codes % 2) + rng.normal(scale=0.5, size=n_rows)
+    return X, pd.Series((signal > signal.median()).astype(int), name="bin_class")
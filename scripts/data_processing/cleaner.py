@@ -16,6 +16,18 @@ from multiprocessing import Pool
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
 
+# Sparse matrices
+# --------------------------------------------------------
+import scipy.sparse as sp
+
+# Stage instrumentation
+# --------------------------------------------------------
+from helper.profiling import profiled
+
+# Shared category dictionaries and numeric downcasting
+# --------------------------------------------------------
+from .layout import CategoryRegistry, downcast, int_type
+
 
 dict_reviewStatus_to_map = {'criteria provided,single submitter': "criteria_provided_no_conflict",
                             'no classification provided': "not_classified",
@@ -132,85 +144,201 @@ def clean_html(html):
     return match.group(1) if match else 'no info'
 
 
-def cleaning(df: pd.DataFrame, df_name):
+# Native Polars equivalents of clean_html and simplify_json
+# --------------------------------------------------------
+review_status_pattern = r'<small>based on: (.*?)</small>'
+hgvs_position_pattern = r'[a-z]\.\-?\d+'
+hgvs_number_pattern = r'\d+'
+hgvs_symbol_pattern = r'[+\[\]_*\.\=]'
 
-    if df_name in ["cancermama_clinvarmain", "variation_information"]:
-        # Change pandas to polars
-        df = pl.from_pandas(df)
-
-        # Calculate the threshold for 50% missing values
-        threshold: float = len(df) * 0.5
-
-        # Identify columns with more than 50% missing values
-        columns_to_remove: List[str] = [
-            col for col in df.columns if df[col].null_count() > threshold]
-
-        # Identify columns with only a single unique value
-        columns_to_remove.extend(
-            [col for col in df.columns if df[col].n_unique() == 1])
-        columns_to_remove.extend(
-            [col for col in df.columns if col == "lastEval"])
-
-        # Remove the identified columns
-        df: pl.DataFrame = df.drop(columns_to_remove)
-
-        # Isolate the specific part of the string in the origName column and convert it to lowercase
-        if "origName" in df.columns:
-
-            df = df.with_columns(
-                pl.col("origName")
-                # Extract the specific part
-                .str.extract(r'(\w+\.\w+\(.*?\):.*?$)', 1)
-                    .str.to_lowercase()
-                    .alias("ClinInfo")  # Save it in a new column
-            )
-
-        if "ClinInfo" in df.columns:
-            df = df.with_columns(
-                pl.col("ClinInfo")
+
+def clean_html_expr(col: str) -> pl.Expr:
+
+    # Same as clean_html, nulls are kept as nulls like map_elements does
+    return (pl.when(pl.col(col).is_null())
+            .then(None)
+            .otherwise(pl.col(col).str.extract(review_status_pattern, 1).fill_null("no info")))
+
+
+def simplify_json_column(df: pl.DataFrame, col: str, alias: str) -> pl.DataFrame:
+
+    # Same as simplify_json: one row per mutation, cleaned, then deduplicated and sorted per variant
+    simplified = (df.select(pl.col(col).str.json_decode(pl.List(pl.List(pl.Utf8))).alias(alias))
+                  .with_row_index("row_nr")
+                  .explode(alias)
+                  .with_columns(pl.col(alias).list.first()
+                                .str.replace_all(hgvs_position_pattern, "")
+                                .str.replace_all(hgvs_number_pattern, "")
+                                .str.replace_all(hgvs_symbol_pattern, ""))
+                  .filter(pl.col(alias) != "-")
+                  .unique(["row_nr", alias])
+                  .sort(["row_nr", alias])
+                  .group_by("row_nr", maintain_order=True)
+                  .agg(pl.col(alias).str.concat(", ")))
+
+    # Variants without any mutation left, or whose mutations all simplify to "", are "no_info",
+    # nulls are kept as nulls like map_elements does
+    df = df.with_row_index("row_nr").join(simplified, on="row_nr", how="left").drop("row_nr")
+    return df.with_columns(pl.when(pl.col(col).is_null())
+                           .then(None)
+                           .when(pl.col(alias).is_null() | (pl.col(alias) == ""))
+                           .then(pl.lit("no_info"))
+                           .otherwise(pl.col(alias))
+                           .alias(alias))
+
+
+def collapse_rare_expr(col: str, min_count: int) -> pl.Expr:
+
+    # Replace categories appearing less than min_count times with "other"
+    return (pl.when(pl.col(col).is_not_null() & (pl.len().over(col) < min_count))
+            .then(pl.lit("other"))
+            .otherwise(pl.col(col))
+            .alias(col))
+
+
+def drop_uninformative_columns(df: pl.DataFrame) -> pl.DataFrame:
+
+    # Calculate the threshold for 50% missing values
+    threshold: float = len(df) * 0.5
+
+    # Identify columns with more than 50% missing values
+    columns_to_remove: List[str] = [
+        col for col in df.columns if df[col].null_count() > threshold]
+
+    # Identify columns with only a single unique value
+    columns_to_remove.extend(
+        [col for col in df.columns if df[col].n_unique() == 1])
+    columns_to_remove.extend(
+        [col for col in df.columns if col == "lastEval"])
+
+    # Remove the identified columns
+    return df.drop(columns_to_remove)
+
+
+def extract_clin_info(df: pl.DataFrame) -> pl.DataFrame:
+
+    # Isolate the specific part of the string in the origName column and convert it to lowercase
+    if "origName" in df.columns:
+
+        df = df.with_columns(
+            pl.col("origName")
+            # Extract the specific part
+            .str.extract(r'(\w+\.\w+\(.*?\):.*?$)', 1)
                 .str.to_lowercase()
-            )
-
-        if "reviewStatus" in df.columns:
-            df = df.with_columns(pl.col("reviewStatus")
-                                 .map_elements(clean_html, return_dtype=str)
-                                 .map_elements(lambda x: dict_reviewStatus_to_map
-                                 .get(x, x), return_dtype=str)
-                                 .alias("reviewStatus"))
-
-        if "_jsonHgvsTable" in df.columns:
-            df = df.with_columns(pl.col("_jsonHgvsTable")
-                     .map_elements(simplify_json, return_dtype=str)
-                     .alias("simplified_hgvs"))
-            df = df.with_columns(pl.col("simplified_hgvs")
-                   .str.strip_chars()
-                   .str.replace("---", "-")
-                   .str.replace("--", "-"))
-
-        # Change to pandas
-        df = df.to_pandas()
-        # Count occurrences of each category in simplified_hgvs
-        if "simplified_hgvs" in df.columns:
-            df["simplified_hgvs"] = df["simplified_hgvs"].str.replace("--", "-")
-            category_counts = df["simplified_hgvs"].value_counts()
-            # Replace categories with count of 2 or less with "other"
-            df["simplified_hgvs"] = df["simplified_hgvs"].apply(lambda x: "other" if category_counts[x] < 2 else x)
-            df = df.drop(["_jsonHgvsTable"], axis=1)
-            
-        if "origin" in df.columns:
-            df["origin"] = df["origin"].replace(origin_dict)
-            category_counts = df["origin"].value_counts()
-            # Replace categories with count of 2 or less with "other"
-            df["origin"] = df["origin"].apply(lambda x: "other" if category_counts[x] <= 3 else x)
-            
-        else:
-            pass
-            
-        object_cols = df.select_dtypes(include=['object']).columns
-        for i in object_cols:
-            df[i] = df[i].str.lower()
-            df[i] = df[i].astype("category")
-        return df
+                .alias("ClinInfo")  # Save it in a new column
+        )
+
+    if "ClinInfo" in df.columns:
+        df = df.with_columns(
+            pl.col("ClinInfo")
+            .str.to_lowercase()
+        )
+
+    return df
+
+
+def cleaning_python(df: pl.DataFrame, dataset=None, registry=None) -> pd.DataFrame:
+
+    # Row by row version, kept as reference for cleaning_polars
+    registry = registry or CategoryRegistry()
+    if "reviewStatus" in df.columns:
+        df = df.with_columns(pl.col("reviewStatus")
+                             .map_elements(clean_html, return_dtype=str)
+                             .map_elements(lambda x: dict_reviewStatus_to_map
+                             .get(x, x), return_dtype=str)
+                             .alias("reviewStatus"))
+
+    if "_jsonHgvsTable" in df.columns:
+        df = df.with_columns(pl.col("_jsonHgvsTable")
+                 .map_elements(simplify_json, return_dtype=str)
+                 .alias("simplified_hgvs"))
+        df = df.with_columns(pl.col("simplified_hgvs")
+               .str.strip_chars()
+               .str.replace("---", "-")
+               .str.replace("--", "-"))
+
+    # Change to pandas
+    df = df.to_pandas()
+    # Count occurrences of each category in simplified_hgvs
+    if "simplified_hgvs" in df.columns:
+        df["simplified_hgvs"] = df["simplified_hgvs"].str.replace("--", "-")
+        category_counts = df["simplified_hgvs"].value_counts()
+        # Replace categories with count of 2 or less with "other"
+        df["simplified_hgvs"] = df["simplified_hgvs"].apply(lambda x: "other" if category_counts[x] < 2 else x)
+        df = df.drop(["_jsonHgvsTable"], axis=1)
+
+    if "origin" in df.columns:
+        df["origin"] = df["origin"].replace(origin_dict)
+        category_counts = df["origin"].value_counts()
+        # Replace categories with count of 2 or less with "other"
+        df["origin"] = df["origin"].apply(lambda x: "other" if category_counts[x] <= 3 else x)
+
+    object_cols = df.select_dtypes(include=['object']).columns
+    for i in object_cols:
+        df[i] = df[i].str.lower()
+    return registry.encode(df, dataset, object_cols)
+
+
+def cleaning_polars(df: pl.DataFrame, dataset=None, registry=None) -> pd.DataFrame:
+
+    # Vectorized version, every step runs as a native Polars expression
+    registry = registry or CategoryRegistry()
+    if "reviewStatus" in df.columns:
+        df = df.with_columns(clean_html_expr("reviewStatus")
+                             .replace(dict_reviewStatus_to_map)
+                             .alias("reviewStatus"))
+
+    if "_jsonHgvsTable" in df.columns:
+        df = simplify_json_column(df, "_jsonHgvsTable", "simplified_hgvs")
+        df = df.with_columns(pl.col("simplified_hgvs")
+                             .str.strip_chars()
+                             .str.replace("---", "-", literal=True)
+                             .str.replace("--", "-", literal=True)
+                             .str.replace_all("--", "-", literal=True)
+                             .alias("simplified_hgvs"))
+        df = df.with_columns(collapse_rare_expr("simplified_hgvs", 2))
+        df = df.drop(["_jsonHgvsTable"])
+
+    if "origin" in df.columns:
+        df = df.with_columns(pl.col("origin").replace(origin_dict))
+        df = df.with_columns(collapse_rare_expr("origin", 4))
+
+    # Lowercase every string column before going back to pandas
+    string_cols = [col for col, dtype in df.schema.items() if dtype == pl.Utf8]
+    df = df.with_columns([pl.col(col).str.to_lowercase() for col in string_cols])
+
+    # Categories from the registry, so pandas gets the codes straight from the Enum columns
+    df = registry.encode_polars(df, dataset, string_cols)
+    return df.to_pandas()
+
+
+@profiled("cleaning")
+def cleaning(df: pd.DataFrame, df_name, engine="polars", registry=None):
+    """
+    Clean one of the raw tables.
+    Args:
+        df (DataFrame): Raw table, pandas or polars.
+        df_name (str): cancermama_clinvarmain, variation_information or UP.geneVsrepList.
+        engine (str): "polars" or "python", the row by row reference.
+        registry (CategoryRegistry): Category dictionaries of the string columns shared between calls,
+            e.g. data_processing.layout.registry. By default a fresh one with the sorted observed values.
+    Returns:
+        DataFrame: Cleaned table, strings as categoricals and numbers downcast.
+    """
+    registry = registry or CategoryRegistry()
+
+    if df_name in ["cancermama_clinvarmain", "variation_information"]:
+        # Change pandas to polars, frames from helper.loader.read_csv_streaming are already polars
+        if isinstance(df, pd.DataFrame):
+            df = pl.from_pandas(df)
+        df = drop_uninformative_columns(df)
+        df = extract_clin_info(df)
+
+        if engine == "polars":
+            return downcast(cleaning_polars(df, df_name, registry))
+        if engine == "python":
+            return downcast(cleaning_python(df, df_name, registry))
+        raise ValueError("invalid engine, valid options are polars and python")
 
     if df_name == "UP.geneVsrepList":
         df = parse_dataframe(df)
@@ -233,7 +361,7 @@ def compare_columns(df: pd.DataFrame, col1_name: str, col2_name: str) -> str:
     return None
 
 
-def compare_and_drop_duplicates(df: pd.DataFrame) -> pd.DataFrame:
+def compare_and_drop_duplicates_pairwise(df: pd.DataFrame) -> pd.DataFrame:
 
     columns_to_drop = []
     columns = df.columns
@@ -261,10 +389,122 @@ def compare_and_drop_duplicates(df: pd.DataFrame) -> pd.DataFrame:
 
     return df
 
+
+def column_hashes(col: pd.Series) -> np.ndarray:
+
+    # One uint64 hash per row, numeric columns as float64 so 1 and 1.0 hash the same,
+    # categories hash like their values and every missing value gets the same hash
+    if pd.api.types.is_numeric_dtype(col.dtype) and not isinstance(col.dtype, pd.CategoricalDtype):
+        col = col.astype("float64")
+    hashes = pd.util.hash_pandas_object(col, index=False).values
+    hashes[col.isna().values] = np.iinfo(np.uint64).max
+    return hashes
+
+
+def column_fingerprints(df: pd.DataFrame, n_blocks=1, seed=2024) -> np.ndarray:
+
+    # Weighted sum of the row hashes of every column over n_blocks blocks of rows, shape (n_blocks, n_columns).
+    # Columns are hashed one at a time, equal columns (or blocks) always get equal fingerprints
+    weights = np.random.default_rng(seed).integers(1, np.iinfo(np.int64).max, len(df), dtype=np.uint64) | np.uint64(1)
+    starts = np.array([block[0] for block in np.array_split(np.arange(len(df)), n_blocks)])
+    fingerprints = np.empty((n_blocks, df.shape[1]), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for j, (_, col) in enumerate(df.items()):
+            fingerprints[:, j] = np.add.reduceat(column_hashes(col) * weights, starts, dtype=np.uint64)
+    return fingerprints
+
+
+def count_differences(col1: pd.Series, col2: pd.Series) -> int:
+
+    # Same count as len(col1.compare(col2)): rows where values differ, missing values compare equal
+    if isinstance(col1.dtype, pd.CategoricalDtype) and isinstance(col2.dtype, pd.CategoricalDtype):
+        return count_code_differences(col1, col2)
+    values1 = col1.to_numpy(dtype=object) if isinstance(col1.dtype, pd.CategoricalDtype) else col1.to_numpy()
+    values2 = col2.to_numpy(dtype=object) if isinstance(col2.dtype, pd.CategoricalDtype) else col2.to_numpy()
+    both_missing = pd.isna(values1) & pd.isna(values2)
+    return int((~((values1 == values2) | both_missing)).sum())
+
+
+def count_code_differences(col1: pd.Series, col2: pd.Series) -> int:
+
+    # Two categoricals compared by their codes, the categories of col2 translated to the codes of col1
+    codes1 = col1.cat.codes.to_numpy()
+    codes2 = col2.cat.codes.to_numpy()
+    if not col1.cat.categories.equals(col2.cat.categories):
+        # -2 for the values col1 never takes, -1 (missing) stays -1
+        translation = col1.cat.categories.get_indexer(col2.cat.categories)
+        translation = np.append(np.where(translation < 0, -2, translation), -1)
+        codes2 = translation[codes2]
+    return int((codes1 != codes2).sum())
+
+
+def compare_and_drop_duplicates_hash(df: pd.DataFrame, max_differences=10) -> pd.DataFrame:
+
+    columns = df.columns
+    # Fingerprints of the max_differences + 1 blocks of rows of every column, their sum is the
+    # fingerprint of the whole column
+    n_blocks = min(max_differences + 1, len(df))
+    block_fingerprints = column_fingerprints(df, n_blocks) if len(df) > max_differences else None
+    with np.errstate(over="ignore"):
+        full_fingerprints = block_fingerprints.sum(axis=0, dtype=np.uint64) if block_fingerprints is not None \
+            else column_fingerprints(df, 1)[0] if len(df) else np.zeros(df.shape[1], dtype=np.uint64)
+
+    # Group columns by fingerprint, only columns in the same bucket can be duplicates
+    buckets = {}
+    for j, value in enumerate(full_fingerprints):
+        buckets.setdefault(value, []).append(j)
+
+    # Exact verification inside each bucket, the first column of each group of duplicates is kept
+    duplicate_of = {}
+    for bucket in buckets.values():
+        kept = []
+        for j in bucket:
+            original = next((k for k in kept if count_differences(df.iloc[:, k], df.iloc[:, j]) == 0), None)
+            if original is None:
+                kept.append(j)
+            else:
+                duplicate_of[j] = original
+
+    # Near duplicates: splitting the rows in max_differences + 1 blocks, two columns with at most
+    # max_differences differences must have at least one identical block
+    candidates = set()
+    if block_fingerprints is None:
+        candidates = {(i, j) for i in range(len(columns)) for j in range(i + 1, len(columns))}
+    else:
+        for fingerprints in block_fingerprints:
+            block_buckets = {}
+            for j, value in enumerate(fingerprints):
+                block_buckets.setdefault(value, []).append(j)
+            for bucket in block_buckets.values():
+                candidates.update((i, j) for n, i in enumerate(bucket) for j in bucket[n + 1:])
+
+    # Report the pairs of columns with only a few differences, columns of the same group of exact
+    # duplicates are skipped
+    group = {j: duplicate_of.get(j, j) for j in range(len(columns))}
+    for i, j in sorted(candidates):
+        if group[i] != group[j]:
+            n_differences = count_differences(df.iloc[:, i], df.iloc[:, j])
+            if 0 < n_differences <= max_differences:
+                print(
+                    f"Columns '{columns[i]}' and '{columns[j]}' have {n_differences} differences.")
+
+    columns_to_drop = [columns[j] for j in sorted(duplicate_of)]
+    return df.drop(columns=columns_to_drop)
+
+
+@profiled("compare_and_drop_duplicates")
+def compare_and_drop_duplicates(df: pd.DataFrame, engine="hash") -> pd.DataFrame:
+
+    if engine == "hash":
+        return compare_and_drop_duplicates_hash(df)
+    if engine == "pairwise":
+        return compare_and_drop_duplicates_pairwise(df)
+    raise ValueError("invalid engine, valid options are hash and pairwise")
+
 # Function to process the DataFrame
 
 
-def parse_dataframe(df):
+def parse_dataframe_python(df):
 
     df = df.rename(columns={4: "gene", 6: "sign", 7: "to_parse"})
     cols_to_drop = [0, 1, 2, 3, 5]
@@ -296,7 +536,85 @@ def parse_dataframe(df):
     return pd.DataFrame(result)
 
 
-def wide_upgenevsrep(df):
+def parse_dataframe_polars(df):
+
+    df = pl.from_pandas(df[[4, 7]].rename(columns={4: "gene", 7: "to_parse"}))
+
+    # One row per ">kind|position" item, the first split element is empty
+    result = (df.with_row_index("row_nr")
+              .with_columns(pl.col("to_parse").str.split(">").list.slice(1))
+              .explode("to_parse")
+              .drop_nulls("to_parse")
+              .with_columns(pl.col("to_parse").str.split("|").alias("parts"))
+              .select("row_nr", "gene",
+                      pl.col("parts").list.get(0).alias("kind"),
+                      pl.col("parts").list.get(1).alias("position"))
+              # Count occurrences of each (kind, position) pair per row, in order of first appearance
+              .group_by(["row_nr", "gene", "kind", "position"], maintain_order=True)
+              .len()
+              .select("gene", "kind", "position", pl.col("len").cast(pl.Int64).alias("counts")))
+
+    if result.is_empty():
+        return pd.DataFrame([])
+    return result.to_pandas()
+
+
+@profiled("parse_dataframe")
+def parse_dataframe(df, engine="polars"):
+
+    if engine == "polars":
+        return parse_dataframe_polars(df)
+    if engine == "python":
+        return parse_dataframe_python(df)
+    raise ValueError("invalid engine, valid options are polars and python")
+
+
+def iter_parse_dataframe(chunks, engine="polars"):
+
+    # Rows are parsed independently, so a repeat list read in chunks, e.g.
+    # pd.read_csv(path, sep="\t", header=None, chunksize=100000), is parsed in constant memory
+    for chunk in chunks:
+        yield parse_dataframe(chunk, engine=engine)
+
+
+def wide_upgenevsrep_sparse(df):
+
+    # Same table as wide_upgenevsrep, built straight into a CSR matrix without pivoting
+    kind_num = df.groupby(['gene', 'kind']).cumcount().to_numpy() + 1
+    gene_idx, genes = pd.factorize(df['gene'], sort=True)
+    kind_idx, kinds = pd.factorize(df['kind'])
+
+    # Integer key per output column, num 0 is the "<kind>_counts" column of each kind
+    stride = kind_num.max() + 1
+    keys = np.concatenate([kind_idx * stride + kind_num, kind_idx * stride])
+    unique_keys, key_idx = np.unique(keys, return_inverse=True)
+
+    # Name only the distinct columns and sort them like the dense version
+    names = np.array([f"{kinds[key // stride]}_{key % stride}" if key % stride else f"{kinds[key // stride]}_counts"
+                      for key in unique_keys])
+    order = np.argsort(names, kind='stable')
+    col_idx = np.empty_like(order)
+    col_idx[order] = np.arange(len(order))
+
+    rows = np.concatenate([gene_idx, gene_idx])
+    values = np.concatenate([df['position'].astype(int).to_numpy(),
+                             df['counts'].to_numpy()]).astype(np.int64)
+
+    # Duplicated (gene, kind) count entries are summed by the COO to CSR conversion
+    matrix = sp.coo_matrix((values, (rows, col_idx[key_idx])), shape=(len(genes), len(names))).tocsr()
+    matrix.eliminate_zeros()
+    # Smallest type once duplicated entries are summed
+    matrix = matrix.astype(int_type(matrix.data.min(initial=0), matrix.data.max(initial=0)))
+
+    return matrix, pd.Index(genes, name='gene'), pd.Index(names[order])
+
+
+def wide_upgenevsrep(df, sparse=False):
+
+    # With sparse=True returns (csr_matrix, gene index, column index) instead of a dense DataFrame
+    if sparse:
+        return wide_upgenevsrep_sparse(df)
+
     # Create a new column that numbers each occurrence of a kind for each gene
     df['kind_num'] = df.groupby(['gene', 'kind']).cumcount() + 1
     
@@ -324,7 +642,7 @@ def wide_upgenevsrep(df):
     # Fill NaN values with 0
     result = result.fillna(0)
     
-    # Convert all values to integers
-    result = result.astype(int)
+    # Integers in the smallest type holding the largest position or count
+    result = downcast(result.astype(int))
 
     return result
\ No newline at end of file
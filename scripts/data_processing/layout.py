@@ -0,0 +1,133 @@
+from pathlib import Path
+import json
+import numpy as np
+import pandas as pd
+import polars as pl
+
+# Integer types tried from the smallest, unsigned types are left out so differences never wrap around
+int_types = [np.int8, np.int16, np.int32, np.int64]
+
+
+class CategoryRegistry:
+    """
+    Category dictionary of every (dataset, column), shared by the cleaner and the selector.
+    New values are appended after the known ones, so the code of a value never changes between
+    stages or data releases and categorical columns can be compared and counted by their codes.
+    With a directory the dictionaries are kept in <directory>/<dataset>.json, which lets
+    processes (e.g. the pipeline stages) share them.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory is not None else None
+        self.categories = {}
+
+    def path(self, dataset):
+        return self.directory / f"{dataset}.json"
+
+    def load(self, dataset):
+        if dataset not in self.categories:
+            path = self.path(dataset) if self.directory is not None else None
+            self.categories[dataset] = json.loads(path.read_text()) if path and path.exists() else {}
+        return self.categories[dataset]
+
+    def save(self, dataset):
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path(dataset).write_text(json.dumps(self.categories[dataset], indent=1))
+
+    def update(self, dataset, values):
+        """
+        Add the values seen in a new frame to the dictionaries of a dataset.
+        Args:
+            dataset (str): Name of the dataset, e.g. the df_name given to cleaning.
+            values (dict): Column name to the distinct non-missing values of the column.
+        Returns:
+            dict: Column name to the full list of categories, known values first.
+        """
+        known = self.load(dataset)
+        changed = False
+        for column, column_values in values.items():
+            categories = known.setdefault(column, [])
+            seen = set(categories)
+            new = sorted(str(value) for value in column_values if str(value) not in seen)
+            if new:
+                categories.extend(new)
+                changed = True
+        if changed:
+            self.save(dataset)
+        return {column: known[column] for column in values}
+
+    def encode_polars(self, df: pl.DataFrame, dataset, columns) -> pl.DataFrame:
+        # String columns to Enum, which to_pandas turns into categoricals without Python strings
+        categories = self.update(dataset, {col: df[col].drop_nulls().unique().to_list() for col in columns})
+        return df.with_columns([pl.col(col).cast(pl.Enum(categories[col])) for col in columns])
+
+    def encode(self, df: pd.DataFrame, dataset, columns=None) -> pd.DataFrame:
+        # Same as encode_polars for a pandas frame, object and category columns by default
+        if columns is None:
+            columns = df.select_dtypes(include=["object", "category"]).columns
+        categories = self.update(dataset, {col: df[col].dropna().unique() for col in columns})
+        for col in columns:
+            df[col] = df[col].astype(pd.CategoricalDtype(categories[col]))
+        return df
+
+
+# Shared in-memory registry, opt-in: pass it to cleaning to keep the codes of a dataset between calls.
+# Without a registry every call gets a fresh one with the sorted categories of its own values
+registry = CategoryRegistry()
+
+
+def int_type(low, high):
+    # Smallest signed integer type holding low and high
+    return next(t for t in int_types if np.iinfo(t).min <= low and high <= np.iinfo(t).max)
+
+
+def downcast(df: pd.DataFrame, floats=True) -> pd.DataFrame:
+    """
+    Store numeric columns in the smallest type that keeps every value.
+    Args:
+        df (DataFrame): Frame to downcast, nullable and boolean columns are left as they are.
+        floats (bool): Also store float64 columns as float32 when no value changes.
+    Returns:
+        DataFrame: The frame with the new types, unchanged columns are not copied.
+    """
+    dtypes = {}
+    numeric = [col for col, dtype in df.dtypes.items() if isinstance(dtype, np.dtype) and dtype.kind in "iuf"]
+    if not numeric:
+        return df
+    # Block-wise reductions instead of one pass per column, which matters for the wide tables
+    lows, highs = df.min(numeric_only=True), df.max(numeric_only=True)
+    for col in numeric:
+        dtype = df.dtypes[col]
+        if dtype.kind in "iu":
+            if pd.isna(lows[col]):
+                continue
+            target = np.dtype(int_type(lows[col], highs[col]))
+            if target.itemsize < dtype.itemsize:
+                dtypes[col] = target
+        elif floats and dtype == np.float64:
+            values = df[col].to_numpy()
+            if np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True):
+                dtypes[col] = np.float32
+    return df.astype(dtypes, copy=False) if dtypes else df
+
+
+def fill_category(col: pd.Series, value) -> pd.Series:
+    # fillna of a categorical column without going through object
+    if not isinstance(col.dtype, pd.CategoricalDtype):
+        return col.fillna(value)
+    if value not in col.cat.categories:
+        col = col.cat.add_categories([value])
+    return col.fillna(value)
+
+
+def memory_report(df: pd.DataFrame) -> pd.Series:
+    """
+    Bytes used by every column of a frame, strings and categories included.
+    Args:
+        df (DataFrame): Frame to measure.
+    Returns:
+        Series: Bytes per column plus the index, the total is report.sum().
+    """
+    return df.memory_usage(deep=True)
@@ -4,116 +4,75 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
-def plot_hypersurface(results, figname):
+# Parameter pairs of the two hypersurface figures, as columns of the trial records
+projections = {"a": (1, 2), "b": (0, 1)}
+parameter_names = ["n_neighbors", "min_samples", "min_cluster_size"]
 
-    # Extract data for plotting
-    n_neighbors_vals, min_samples_vals, min_cluster_size_vals, scores = zip(*results)
-    
-    # Create a grid of parameter values
-    n_neighbors_vals = np.array(n_neighbors_vals)
-    min_samples_vals = np.array(min_samples_vals)
-    min_cluster_size_vals = np.array(min_cluster_size_vals)
-    scores = np.array(scores)
-    
-    # Define the grid ranges
-    n_neighbors_range = np.linspace(n_neighbors_vals.min(), n_neighbors_vals.max(), 50)
-    min_samples_range = np.linspace(min_samples_vals.min(), min_samples_vals.max(), 50)
-    min_cluster_size_range = np.linspace(min_cluster_size_vals.min(), min_cluster_size_vals.max(), 50)
+def interpolate_surface(x, y, values, resolution=50):
 
-    # Create the meshgrid for plotting
-    N, M = np.meshgrid(min_samples_range, min_cluster_size_range)
-    Z = np.zeros_like(N)
+    # One triangulation of the trial points, the whole meshgrid is interpolated in one call
+    x_range = np.linspace(x.min(), x.max(), resolution)
+    y_range = np.linspace(y.min(), y.max(), resolution)
+    N, M = np.meshgrid(x_range, y_range)
+    Z = griddata(np.column_stack([x, y]), values, (N, M), method='cubic')
+    return N, M, Z
 
-    points = np.array(list(zip(n_neighbors_vals, min_samples_vals, min_cluster_size_vals)))
-    values = scores
+def hypersurfaces(results, resolution=50):
+    """
+    Interpolated score surfaces of an optimization study, without rendering them.
+    Args:
+        results (list): Trial records (n_neighbors, min_samples, min_cluster_size, score, mode, fraction),
+            rejected trials and trials pruned on a subsample are left out. Records of older runs
+            (n_neighbors, min_samples, min_cluster_size, score) are all used.
+        resolution (int): Number of grid points along each axis.
+    Returns:
+        dict: For each projection ("a": min_samples x min_cluster_size, "b": n_neighbors x min_samples)
+        the meshgrid arrays N, M and the interpolated scores Z.
+    """
+    results = [record for record in results if len(record) < 6 or (record[4] != "rejected" and record[5] == 1.0)]
+    records = np.array([record[:4] for record in results], dtype=np.float64)
+    return {name: interpolate_surface(records[:, i], records[:, j], records[:, 3], resolution)
+            for name, (i, j) in projections.items()}
 
-    for i in range(len(min_samples_range)):
-        for j in range(len(min_cluster_size_range)):
-            Z[j, i] = griddata(points[:, :2], values, (N[j, i], M[j, i]), method='cubic')
-    
-    # Find the maximum score and its corresponding parameters
-    max_score_index = np.argmax(scores)
-    max_n_neighbors = n_neighbors_vals[max_score_index]
-    max_min_samples = min_samples_vals[max_score_index]
-    max_min_cluster_size = min_cluster_size_vals[max_score_index]
-    max_score = scores[max_score_index]
+def draw_surface_views(fig, N, M, Z, xlabel, ylabel, views=((30, 60), (40, 80))):
+
+    # Create the 3D surface plot, once per view
+    for k, (elev, azim) in enumerate(views):
+        ax = fig.add_subplot(1, len(views), k + 1, projection='3d', computed_zorder=False)
+        ax.plot_surface(N, M, Z, cmap=cm.coolwarm, linewidth=0, antialiased=True, zorder=0)
+        # Customize the axes
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_zlabel('Silhouette Score')
+        ax.view_init(elev=elev, azim=azim, roll=0)  # Adjust elev and azim to get different views
+    fig.tight_layout()
+
+def plot_surface_views(N, M, Z, xlabel, ylabel, path, views=((30, 60), (40, 80))):
 
-    # Create the 3D surface plot
-    fig = plt.figure(figsize=(15,10))
-    ax1 = fig.add_subplot(121, projection='3d', computed_zorder=False)
-    surf1 = ax1.plot_surface(N, M, Z, cmap=cm.coolwarm, linewidth=0, antialiased=True, zorder=0)
-    #ax1.scatter(max_min_samples, max_min_cluster_size, max_score-0.2, color='black', s=10, zorder=2.5)
-    
-    # Customize the axes
-    ax1.set_xlabel('min_samples')
-    ax1.set_ylabel('min_cluster_size')
-    #ax1.set_ylim(0, 20)
-    ax1.set_zlabel('Silhouette Score')
-    ax1.view_init(elev=30, azim=60, roll=0)#, vertical_axis="z")  # Adjust elev and azim to get different views
-    
-    # Add a color bar which maps values to colors
-    #fig.colorbar(surf, shrink=0.5, aspect=5)
-    
-    ax2 = fig.add_subplot(122, projection='3d', computed_zorder=False)
-    surf2 = ax2.plot_surface(N, M, Z, cmap=cm.coolwarm, linewidth=0, antialiased=True, zorder=0)
-    #ax2.scatter(max_min_samples, max_min_cluster_size, max_score-0.2, color='black', s=10, zorder=2.5)
-    # Customize the axes
-    ax2.set_xlabel('min_samples')
-    ax2.set_ylabel('min_cluster_size')
-    #ax2.set_ylim(0,20)
-    ax2.set_zlabel('Silhouette Score')
-    ax2.view_init(elev=40, azim=80, roll=0)#, vertical_axis="z")  # Adjust elev and azim to get different views
-    
-    plt.tight_layout()
-    plt.savefig(f"./results/figures/upgenevsrep_clustering_{figname}_a.png", dpi=300)
-    
-    # Second plot
-    # ---------------------------------------------------------------------------------------
-    N, M = np.meshgrid(n_neighbors_range, min_samples_range)
-    Z = np.zeros_like(N)
-    points = np.array(list(zip(n_neighbors_vals, min_samples_vals, min_cluster_size_vals)))
-    values = scores
-    
-    for i in range(len(n_neighbors_range)):
-        for j in range(len(min_samples_range)):
-            Z[j, i] = griddata(points[:, :2], values, (N[j, i], M[j, i]), method='cubic')
-    
-    # Find the maximum score and its corresponding parameters
-    max_score_index = np.argmax(scores)
-    max_n_neighbors = n_neighbors_vals[max_score_index]
-    max_min_samples = min_samples_vals[max_score_index]
-    max_min_cluster_size = min_cluster_size_vals[max_score_index]
-    max_score = scores[max_score_index]
-    
-    # Create the 3D surface plot
     fig = plt.figure(figsize=(15,10))
-    ax1 = fig.add_subplot(121, projection='3d', computed_zorder=False)
-    surf1 = ax1.plot_surface(N, M, Z, cmap=cm.coolwarm, linewidth=0, antialiased=True, zorder=0)
-    #ax1.scatter(max_n_neighbors, max_min_samples, max_score, color='white', s=10, zorder=2.5)
-    
-    # Customize the axes
-    ax1.set_xlabel('n_neighbors')
-    ax1.set_ylabel('min_samples')
-    ax1.set_zlabel('Silhouette Score')
-    ax1.view_init(elev=30, azim=60)  # Adjust elev and azim to get different views
-    
-    ax2 = fig.add_subplot(122, projection='3d', computed_zorder=False)
-    surf2 = ax2.plot_surface(N, M, Z, cmap=cm.coolwarm, linewidth=0, antialiased=True, zorder=0)
-    #ax2.scatter(max_n_neighbors, max_min_samples, max_score, color='white', s=10, zorder=2.5)
-    # Customize the axes
-    ax2.set_xlabel('n_neighbors')
-    ax2.set_ylabel('min_samples')
-    ax2.set_zlabel('Silhouette Score')
-    ax2.view_init(elev=40, azim=80)  # Adjust elev and azim to get different views
-    
-    plt.tight_layout()
-    plt.savefig(f"./results/figures/upgenevsrep_clustering_{figname}_b.png", dpi=300)
+    draw_surface_views(fig, N, M, Z, xlabel, ylabel, views)
+    fig.savefig(path, dpi=300)
+    # Closed once saved, pyplot would otherwise keep every figure of a study in memory
+    plt.close(fig)
+    return fig
+
+def plot_hypersurface(results, figname, resolution=50, render=True):
+
+    # Surfaces over (min_samples, min_cluster_size) and (n_neighbors, min_samples), render=False
+    # only returns the interpolated arrays
+    surfaces = hypersurfaces(results, resolution)
+    if not render:
+        return surfaces
+
+    for name, (i, j) in projections.items():
+        N, M, Z = surfaces[name]
+        plot_surface_views(N, M, Z, parameter_names[i], parameter_names[j],
+                           f"./results/figures/upgenevsrep_clustering_{figname}_{name}.png")
 
     print("Done!")
+    return surfaces
 
-def plot_embeddings_labeled(embedding, labels, filename):
-    
-    fig = plt.figure(figsize=(15, 10))
+def draw_embeddings(fig, embedding, labels):
 
     # Plot UMAP in 3D
     ax2 = fig.add_subplot(122, projection='3d')
@@ -128,4 +87,11 @@ def plot_embeddings_labeled(embedding, labels, filename):
     ax1.set_ylabel('')
     ax1.set_zlabel('')
     ax2.view_init(elev=30, azim=60)
-    plt.savefig(f"./results/figures/{filename}.png", dpi=300)
\ No newline at end of file
+
+def plot_embeddings_labeled(embedding, labels, filename):
+    
+    fig = plt.figure(figsize=(15, 10))
+    draw_embeddings(fig, embedding, labels)
+    fig.savefig(f"./results/figures/{filename}.png", dpi=300)
+    plt.close(fig)
+    return fig
\ No newline at end of file
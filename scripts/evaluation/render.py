@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from pathlib import Path
+import numpy as np
+import matplotlib
+import joblib
+import json
+import os
+
+from .plots import draw_embeddings, draw_surface_views, hypersurfaces, projections, parameter_names
+
+figures_dir = Path("./results/figures")
+# Hash of the inputs of every rendered figure, used to skip figures that did not change
+manifest_name = ".render_hashes.json"
+
+
+def downsample(embedding, labels, max_points=100000, seed=2024):
+
+    # Random subset of the points of a large embedding, the scatter looks the same
+    embedding = np.asarray(embedding)
+    labels = np.asarray(labels)
+    if max_points is None or len(embedding) <= max_points:
+        return embedding, labels
+    idx = np.sort(np.random.default_rng(seed).choice(len(embedding), max_points, replace=False))
+    return embedding[idx], labels[idx]
+
+
+def save_figure(fig, path, dpi):
+
+    # Figures are created without pyplot so nothing keeps them alive after saving
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(path, dpi=dpi)
+    fig.clear()
+
+
+def render_embedding(embedding, labels, filename, max_points=100000, dpi=300, directory=figures_dir):
+    embedding, labels = downsample(embedding, labels, max_points)
+    fig = Figure(figsize=(15, 10))
+    draw_embeddings(fig, embedding, labels)
+    path = Path(directory) / f"{filename}.png"
+    save_figure(fig, path, dpi)
+    return [str(path)]
+
+
+def render_hypersurface(results, figname, resolution=50, dpi=300, directory=figures_dir):
+    surfaces = hypersurfaces(results, resolution)
+    paths = []
+    for name, (i, j) in projections.items():
+        fig = Figure(figsize=(15, 10))
+        draw_surface_views(fig, *surfaces[name], parameter_names[i], parameter_names[j])
+        path = Path(directory) / f"upgenevsrep_clustering_{figname}_{name}.png"
+        save_figure(fig, path, dpi)
+        paths.append(str(path))
+    return paths
+
+
+renderers = {"embedding": render_embedding, "hypersurface": render_hypersurface}
+
+
+def _init_worker():
+    matplotlib.use("Agg")
+
+
+def _render(job):
+    kind, kwargs = job
+    return renderers[kind](**kwargs)
+
+
+def job_key(job):
+    kind, kwargs = job
+    return f"{kind}:{kwargs.get('filename', kwargs.get('figname'))}"
+
+
+def render_figures(jobs, n_jobs=None, force=False, directory=figures_dir):
+    """
+    Render a list of figure jobs headless over a process pool.
+    Args:
+        jobs (list): (kind, kwargs) pairs, kind is "embedding" (kwargs of render_embedding)
+            or "hypersurface" (kwargs of render_hypersurface).
+        n_jobs (int): Number of processes, all cores by default and in-process with 1.
+        force (bool): Render every job even when its inputs did not change.
+        directory (str or Path): Output directory of the figures and of the hash manifest.
+    Returns:
+        dict: Paths of the figures written by each job, skipped jobs are left out.
+    """
+    directory = Path(directory)
+    manifest_path = directory / manifest_name
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    # The content hash covers the arrays and every option, e.g. the dpi
+    pending = []
+    for kind, kwargs in jobs:
+        kwargs = {**kwargs, "directory": directory}
+        key = job_key((kind, kwargs))
+        digest = joblib.hash((kind, kwargs))
+        if force or manifest.get(key, {}).get("hash") != digest or \
+                not all(Path(path).exists() for path in manifest[key]["paths"]):
+            pending.append((key, digest, (kind, kwargs)))
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1 or len(pending) <= 1:
+        # Figure objects render through Agg whatever the pyplot backend of this process is
+        paths = [_render(job) for _, _, job in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(pending)), initializer=_init_worker) as executor:
+            paths = list(executor.map(_render, [job for _, _, job in pending]))
+
+    rendered = {}
+    for (key, digest, _), job_paths in zip(pending, paths):
+        manifest[key] = {"hash": digest, "paths": job_paths}
+        rendered[key] = job_paths
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps(manifest, indent=1))
+    return rendered
@@ -0,0 +1,234 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.stats as ss
+import scipy.cluster.hierarchy as sch
+
+from .selector import contingency_table, map_pair_batches
+
+# Values are rounded to 0 or 1 when they are off by less than this, like dython does
+precision = 1e-13
+
+
+def encode_nominal(col, nan_replace_value=0.0):
+
+    # Integer codes of a nominal column after replacing missing values, like dython's fillna(0.0)
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codes = col.cat.codes.to_numpy().astype(np.int64)
+        categories = col.cat.categories
+        if (codes < 0).any():
+            if nan_replace_value in categories:
+                codes[codes < 0] = categories.get_loc(nan_replace_value)
+            else:
+                codes[codes < 0] = len(categories)
+        # Drop unused categories so the number of categories is the observed one
+        uniques, codes = np.unique(codes, return_inverse=True)
+        return codes, len(uniques)
+    codes, uniques = pd.factorize(col.fillna(nan_replace_value))
+    return codes.astype(np.int64), len(uniques)
+
+
+def entropy(counts):
+
+    # Shannon entropy in nats of a vector of counts
+    counts = counts[counts > 0]
+    p = counts / counts.sum()
+    return float(-(p * np.log(p)).sum())
+
+
+def round_unit_interval(value):
+
+    if -precision <= value < 0.0:
+        return 0.0
+    if 1.0 < value <= 1.0 + precision:
+        return 1.0
+    return value
+
+
+def cramers_v_from_contingency(contingency, bias_correction=True):
+
+    # Same as dython.nominal.cramers_v, chi2 with Yates' correction for 2x2 tables like scipy
+    contingency = contingency[contingency.sum(axis=1) > 0][:, contingency.sum(axis=0) > 0]
+    r, k = contingency.shape
+    n = contingency.sum()
+    expected = np.outer(contingency.sum(axis=1), contingency.sum(axis=0)) / n
+    observed = contingency.astype(np.float64)
+    if (r - 1) * (k - 1) == 1:
+        diff = expected - observed
+        observed = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+    chi2 = ((observed - expected) ** 2 / expected).sum() if (r - 1) * (k - 1) > 0 else 0.0
+    phi2 = chi2 / n
+
+    if bias_correction:
+        phi2corr = max(0, phi2 - ((k - 1) * (r - 1)) / (n - 1))
+        rcorr = r - ((r - 1) ** 2) / (n - 1)
+        kcorr = k - ((k - 1) ** 2) / (n - 1)
+        if min((kcorr - 1), (rcorr - 1)) == 0:
+            return np.nan
+        v = np.sqrt(phi2corr / min((kcorr - 1), (rcorr - 1)))
+    else:
+        v = np.sqrt(phi2 / min(k - 1, r - 1))
+    return round_unit_interval(v)
+
+
+def theils_u_from_contingency(contingency, h_x):
+
+    # U(x|y) with x on the rows of the contingency table, same as dython.nominal.theils_u
+    if h_x == 0:
+        return 1.0
+    n = contingency.sum()
+    p_y = contingency.sum(axis=0) / n
+    nzx, nzy = np.nonzero(contingency)
+    p_xy = contingency[nzx, nzy] / n
+    h_x_given_y = float((p_xy * np.log(p_y[nzy] / p_xy)).sum())
+    return round_unit_interval((h_x - h_x_given_y) / h_x)
+
+
+def correlation_ratio_from_codes(codes, n_categories, measurements):
+
+    # Same as dython.nominal.correlation_ratio, category sums with bincount
+    n_array = np.bincount(codes, minlength=n_categories).astype(np.float64)
+    sums = np.bincount(codes, weights=measurements, minlength=n_categories)
+    present = n_array > 0
+    y_avg_array = sums[present] / n_array[present]
+    n_array = n_array[present]
+    y_total_avg = np.sum(y_avg_array * n_array) / np.sum(n_array)
+    numerator = np.sum(n_array * (y_avg_array - y_total_avg) ** 2)
+    denominator = np.sum((measurements - y_total_avg) ** 2)
+    if numerator == 0:
+        return 0.0
+    eta = np.sqrt(numerator / denominator)
+    return 1.0 if 1.0 < eta <= 1.0 + precision else eta
+
+
+# Codes and entropies shared with the worker processes through the pool initializer
+_codes = None
+_n_categories = None
+_entropies = None
+
+
+def _init_worker(codes, n_categories, entropies):
+    global _codes, _n_categories, _entropies
+    _codes = codes
+    _n_categories = n_categories
+    _entropies = entropies
+
+
+def _nominal_pairs(args):
+    pairs, nom_nom_assoc, bias_correction = args
+    results = []
+    for i, j in pairs:
+        contingency = contingency_table(_codes[:, i], _codes[:, j], _n_categories[i], _n_categories[j])
+        if nom_nom_assoc == "theil":
+            results.append((theils_u_from_contingency(contingency, _entropies[i]),
+                            theils_u_from_contingency(contingency.T, _entropies[j])))
+        else:
+            cell = cramers_v_from_contingency(contingency, bias_correction)
+            results.append((cell, cell))
+    return results
+
+
+def column_entropies(codes, n_categories, columns, entropy_cache=None):
+
+    # Entropy of every nominal column, reusing the values already in entropy_cache. Entries are keyed
+    # by the column name and a hash of its codes, so a cache shared between frames never goes stale
+    entropies = np.empty(len(columns))
+    for k, col in enumerate(columns):
+        key = None
+        if entropy_cache is not None:
+            key = (col, hashlib.sha256(np.ascontiguousarray(codes[:, k]).tobytes()).hexdigest())
+            if key in entropy_cache:
+                entropies[k] = entropy_cache[key]
+                continue
+        entropies[k] = entropy(np.bincount(codes[:, k], minlength=n_categories[k]))
+        if entropy_cache is not None:
+            entropy_cache[key] = entropies[k]
+    return entropies
+
+
+def cluster_order(corr):
+
+    # Same ordering as dython.data_utils.cluster_correlations
+    d = sch.distance.pdist(corr)
+    linkage = sch.linkage(d, method="complete")
+    ind = sch.fcluster(linkage, 0.5 * d.max(), "distance")
+    return np.argsort(ind)
+
+
+def association_matrix(df, nom_nom_assoc="cramer", num_num_assoc="pearson", cramers_v_bias_correction=True,
+                       nan_replace_value=0.0, clustering=False, n_jobs=None, batch_size=256, entropy_cache=None):
+
+    if nom_nom_assoc not in ["cramer", "theil"]:
+        raise ValueError("invalid nom_nom_assoc, valid options are cramer and theil")
+    if num_num_assoc not in ["pearson", "spearman", "kendall"]:
+        raise ValueError("invalid num_num_assoc, valid options are pearson, spearman and kendall")
+
+    columns = df.columns.tolist()
+    nominal = [col for col in columns if df[col].dtype == object or isinstance(df[col].dtype, pd.CategoricalDtype)]
+    numerical = [col for col in columns if col not in nominal]
+    position = {col: k for k, col in enumerate(columns)}
+
+    # Encode every nominal column once and fill numerical columns once
+    codes = np.empty((len(df), len(nominal)), dtype=np.int64)
+    n_categories = np.empty(len(nominal), dtype=np.int64)
+    for k, col in enumerate(nominal):
+        codes[:, k], n_categories[k] = encode_nominal(df[col], nan_replace_value)
+    values = df[numerical].fillna(nan_replace_value).to_numpy(dtype=np.float64)
+    entropies = column_entropies(codes, n_categories, nominal, entropy_cache)
+
+    corr = np.eye(len(columns))
+
+    # Nominal-nominal pairs from shared contingency tables, spread over a process pool
+    pairs = [(i, j) for i in range(len(nominal)) for j in range(i + 1, len(nominal))]
+    batches = [(pairs[k:k + batch_size], nom_nom_assoc, cramers_v_bias_correction)
+               for k in range(0, len(pairs), batch_size)]
+    results = map_pair_batches(_nominal_pairs, batches, _init_worker, (codes, n_categories, entropies), n_jobs)
+    for (i, j), (ij, ji) in zip(pairs, [cell for batch in results for cell in batch]):
+        corr[position[nominal[i]], position[nominal[j]]] = ij
+        corr[position[nominal[j]], position[nominal[i]]] = ji
+
+    # Nominal-numerical pairs, correlation ratio in both directions
+    for i, col in enumerate(nominal):
+        for j, num_col in enumerate(numerical):
+            cell = correlation_ratio_from_codes(codes[:, i], n_categories[i], values[:, j])
+            corr[position[col], position[num_col]] = cell
+            corr[position[num_col], position[col]] = cell
+
+    # Numerical-numerical pairs
+    if len(numerical) > 1:
+        idx = [position[col] for col in numerical]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if num_num_assoc == "pearson":
+                num_corr = np.corrcoef(values, rowvar=False)
+            elif num_num_assoc == "spearman":
+                num_corr = np.corrcoef(ss.rankdata(values, axis=0), rowvar=False)
+            else:
+                num_corr = np.array([[ss.kendalltau(values[:, i], values[:, j])[0] for j in range(len(numerical))]
+                                     for i in range(len(numerical))])
+        np.fill_diagonal(num_corr, 1.0)
+        corr[np.ix_(idx, idx)] = num_corr
+
+    # Invalid values are shown as 0, single valued columns get 0 everywhere
+    corr[~np.isfinite(corr)] = 0.0
+    single_valued = [position[col] for k, col in enumerate(nominal) if n_categories[k] == 1]
+    single_valued += [position[col] for j, col in enumerate(numerical) if np.unique(values[:, j]).size == 1]
+    corr[single_valued, :] = 0.0
+    corr[:, single_valued] = 0.0
+
+    corr = pd.DataFrame(corr, index=columns, columns=columns)
+    if clustering:
+        order = [columns[k] for k in cluster_order(corr.to_numpy())]
+        corr = corr.loc[order, order]
+    return corr
+
+
+def associations(df, nom_nom_assoc="cramer", num_num_assoc="pearson", cramers_v_bias_correction=True,
+                 nan_replace_value=0.0, clustering=False, n_jobs=None, entropy_cache=None, **kwargs):
+
+    # Drop-in for dython.nominal.associations(..., compute_only=True), the plotting
+    # arguments are accepted and ignored
+    corr = association_matrix(df, nom_nom_assoc=nom_nom_assoc, num_num_assoc=num_num_assoc,
+                              cramers_v_bias_correction=cramers_v_bias_correction,
+                              nan_replace_value=nan_replace_value, clustering=clustering,
+                              n_jobs=n_jobs, entropy_cache=entropy_cache)
+    return {"corr": corr, "ax": None}
@@ -2,8 +2,13 @@ from dython.nominal import associations
 from sklearn.feature_selection import mutual_info_classif, chi2, SelectKBest
 import pandas as pd
 import numpy as np
+import os
+import copy
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from helper.profiling import profiled
 
-def select_vars(corr_df):
+def select_vars_melt(corr_df):
 
     melted_df = corr_df.reset_index().melt(id_vars='index', var_name='variable', value_name='corr_value')
     filtered_df = melted_df[(melted_df['index'] != melted_df['variable']) & (melted_df['corr_value'].abs() > 0.85)].copy()
@@ -13,6 +18,84 @@ def select_vars(corr_df):
 
     return result_df
 
+
+def high_correlation_pairs(corr_df, threshold=0.85):
+
+    # Cells above the threshold in the same column-major order melt uses
+    values = corr_df.to_numpy()
+    col_idx, row_idx = np.nonzero((np.abs(values.astype(np.float64)) > threshold).T)
+    index_labels = corr_df.index.to_numpy(dtype=object)[row_idx]
+    column_labels = corr_df.columns.to_numpy(dtype=object)[col_idx]
+    corr_values = values[row_idx, col_idx]
+
+    keep = index_labels != column_labels
+    index_labels, column_labels, corr_values = index_labels[keep], column_labels[keep], corr_values[keep]
+
+    # Sorted pair of labels, only the first cell of each pair is kept
+    swap = column_labels < index_labels
+    var1 = np.where(swap, column_labels, index_labels)
+    var2 = np.where(swap, index_labels, column_labels)
+    codes, labels = pd.factorize(np.concatenate([var1, var2]))
+    keys = codes[:len(var1)].astype(np.int64) * len(labels) + codes[len(var1):]
+    _, first = np.unique(keys, return_index=True)
+    first = np.sort(first)
+
+    return var1[first], var2[first], corr_values[first]
+
+
+@profiled("select_vars")
+def select_vars(corr_df, threshold=0.85):
+
+    var1, var2, corr_values = high_correlation_pairs(corr_df, threshold)
+    result_df = pd.DataFrame({'pair': var1 + ' vs ' + var2, 'corr_value': corr_values})
+
+    return result_df
+
+
+def drop_sequence(corr_df, threshold=0.85):
+
+    # Variables dropped by the select_vars / choose_variable_to_drop loop, one per iteration,
+    # until no pair is above the threshold. The pair graph is built once over integer ids and
+    # updated as variables are dropped, with the same ties as choose_variable_to_drop: the
+    # variable seen first in the remaining pairs wins.
+    var1, var2, _ = high_correlation_pairs(corr_df, threshold)
+    codes, labels = pd.factorize(np.concatenate([var1, var2]))
+    first_var, second_var = codes[:len(var1)], codes[len(var1):]
+
+    degree = np.bincount(codes, minlength=len(labels))
+    # Appearance order of a variable in a pair: 2 * pair rank, +1 when it is the second variable
+    incident = [[] for _ in range(len(labels))]
+    for rank, (a, b) in enumerate(zip(first_var, second_var)):
+        incident[a].append((2 * rank, rank, b))
+        incident[b].append((2 * rank + 1, rank, a))
+    alive = np.ones(len(var1), dtype=bool)
+    pointer = np.zeros(len(labels), dtype=np.int64)
+
+    def first_appearance(v):
+        while not alive[incident[v][pointer[v]][1]]:
+            pointer[v] += 1
+        return incident[v][pointer[v]][0]
+
+    heap = [(-degree[v], first_appearance(v), v) for v in range(len(labels))]
+    heapq.heapify(heap)
+    dropped = []
+    while heap:
+        neg_degree, appearance, v = heapq.heappop(heap)
+        # Skip entries left behind by earlier updates
+        if degree[v] == 0 or -neg_degree != degree[v] or appearance != first_appearance(v):
+            continue
+        dropped.append(labels[v])
+        for _, rank, u in incident[v]:
+            if alive[rank]:
+                alive[rank] = False
+                degree[u] -= 1
+        degree[v] = 0
+        for _, rank, u in incident[v]:
+            if degree[u] > 0:
+                heapq.heappush(heap, (-degree[u], first_appearance(u), u))
+
+    return dropped
+
 # ■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■
 # ■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■
 
@@ -37,6 +120,12 @@ def choose_variable_to_drop(pair_df):
 
     
 def corr_comparison(result_df_1, result_df_2):
+    # AssociationMatrix snapshots are compared through their pairs above the threshold
+    if isinstance(result_df_1, AssociationMatrix):
+        result_df_1 = result_df_1.pairs()
+    if isinstance(result_df_2, AssociationMatrix):
+        result_df_2 = result_df_2.pairs()
+
     # Extract pairs
     pairs_1 = set(result_df_1['pair'])
     pairs_2 = set(result_df_2['pair'])
@@ -69,7 +158,7 @@ def corr_comparison(result_df_1, result_df_2):
 # ■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■
 
 
-def mutual_information(df):
+def mutual_information_pairwise(df):
     
     # Identify categorical columns
     categorical_cols = df.columns.tolist()
@@ -97,4 +186,231 @@ def mutual_information(df):
                 mi_matrix.at[col1, col2] = mi[0]
     
     # Display the mutual information matrix
-    return mi_matrix
\ No newline at end of file
+    return mi_matrix
+
+# ■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■
+# ■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■
+
+
+def column_codes(col):
+
+    # Categoricals from the cleaner already hold their codes, unused categories only add empty rows
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy(), len(col.cat.categories)
+    codes, uniques = pd.factorize(col)
+    return codes, len(uniques)
+
+
+def encode_columns(df):
+
+    # Integer codes per column (-1 for missing values) and number of categories per column
+    codes = np.empty((len(df), df.shape[1]), dtype=np.int64)
+    n_categories = np.empty(df.shape[1], dtype=np.int64)
+    for j, (_, col) in enumerate(df.items()):
+        codes[:, j], n_categories[j] = column_codes(col)
+    return codes, n_categories
+
+
+def contingency_table(x, y, n_x, n_y):
+
+    # Joint counts of two code vectors on the rows where both are present
+    mask = (x >= 0) & (y >= 0)
+    x, y = x[mask], y[mask]
+    if n_x * n_y <= 10_000_000:
+        return np.bincount(x * n_y + y, minlength=n_x * n_y).reshape(n_x, n_y)
+    # Too many combinations for a dense table, count only the observed ones
+    x_idx, x = np.unique(x, return_inverse=True)
+    y_idx, y = np.unique(y, return_inverse=True)
+    return np.bincount(x * len(y_idx) + y, minlength=len(x_idx) * len(y_idx)).reshape(len(x_idx), len(y_idx))
+
+
+def mutual_info_from_contingency(contingency):
+
+    # Same computation as sklearn.metrics.mutual_info_score, in nats
+    contingency = contingency[contingency.sum(axis=1) > 0][:, contingency.sum(axis=0) > 0]
+    if contingency.shape[0] <= 1 or contingency.shape[1] <= 1:
+        return 0.0
+    nzx, nzy = np.nonzero(contingency)
+    nz_val = contingency[nzx, nzy]
+    contingency_sum = contingency.sum()
+    pi = contingency.sum(axis=1)
+    pj = contingency.sum(axis=0)
+    log_contingency_nm = np.log(nz_val)
+    contingency_nm = nz_val / contingency_sum
+    outer = pi.take(nzx).astype(np.int64, copy=False) * pj.take(nzy).astype(np.int64, copy=False)
+    log_outer = -np.log(outer) + np.log(pi.sum()) + np.log(pj.sum())
+    mi = contingency_nm * (log_contingency_nm - np.log(contingency_sum)) + contingency_nm * log_outer
+    mi = np.where(np.abs(mi) < np.finfo(mi.dtype).eps, 0.0, mi)
+    return float(np.clip(mi.sum(), 0.0, None))
+
+
+# Codes shared with the worker processes through the pool initializer
+_codes = None
+_n_categories = None
+
+
+def _init_worker(codes, n_categories):
+    global _codes, _n_categories
+    _codes = codes
+    _n_categories = n_categories
+
+
+def _mutual_info_pairs(pairs):
+    return [mutual_info_from_contingency(contingency_table(_codes[:, i], _codes[:, j],
+                                                          _n_categories[i], _n_categories[j]))
+            for i, j in pairs]
+
+
+def map_pair_batches(func, batches, initializer, initargs, n_jobs=None):
+
+    # Run func on every batch of pairs, in a process pool when there is more than one batch
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1 or len(batches) <= 1:
+        initializer(*initargs)
+        return [func(batch) for batch in batches]
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer, initargs=initargs) as executor:
+        return list(executor.map(func, batches))
+
+
+def mutual_information_matrix(df, n_jobs=None, batch_size=256):
+
+    columns = df.columns.tolist()
+    codes, n_categories = encode_columns(df)
+
+    # Discrete mutual information is symmetric, each unordered pair is computed once
+    pairs = [(i, j) for i in range(len(columns)) for j in range(i + 1, len(columns))]
+    batches = [pairs[k:k + batch_size] for k in range(0, len(pairs), batch_size)]
+
+    results = map_pair_batches(_mutual_info_pairs, batches, _init_worker, (codes, n_categories), n_jobs)
+
+    mi = np.zeros((len(columns), len(columns)), dtype=np.float64)
+    rows, cols = zip(*pairs) if pairs else ((), ())
+    values = [value for batch in results for value in batch]
+    mi[list(rows), list(cols)] = values
+    mi[list(cols), list(rows)] = values
+
+    return pd.DataFrame(mi, index=columns, columns=columns)
+
+
+@profiled("mutual_information")
+def mutual_information(df, engine="matrix", n_jobs=None):
+
+    if engine == "matrix":
+        return mutual_information_matrix(df, n_jobs=n_jobs)
+    if engine == "pairwise":
+        return mutual_information_pairwise(df)
+    raise ValueError("invalid engine, valid options are matrix and pairwise")
+
+# ■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■
+# ■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■■
+
+
+class AssociationMatrix:
+    """
+    Pairwise association scores that are updated instead of recomputed when the columns change.
+    Every column is treated as categorical and encoded once. Dropping columns removes their rows
+    and columns, adding k columns computes only the pairs involving them.
+    measure: "mutual_information" (as mutual_information), "cramer" or "theil" (as
+    feature_selection.association with every column nominal).
+    """
+
+    def __init__(self, df, measure="mutual_information", threshold=0.85, n_jobs=None, batch_size=256):
+        if measure not in ["mutual_information", "cramer", "theil"]:
+            raise ValueError("invalid measure, valid options are mutual_information, cramer and theil")
+        self.measure = measure
+        self.threshold = threshold
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        self.columns = []
+        self.codes = {}
+        self.n_categories = {}
+        self.entropies = {}
+        self.scores = np.zeros((0, 0))
+        self.add_columns(df)
+
+    def encode(self, col):
+        if self.measure == "mutual_information":
+            codes, n_categories = column_codes(col)
+            return codes.astype(np.int64), n_categories
+        from .association import encode_nominal
+        return encode_nominal(col)
+
+    def add_columns(self, df):
+        from .association import _init_worker as init_nominal_worker, _nominal_pairs, entropy
+
+        new_columns = [col for col in df.columns if col not in self.codes]
+        if not new_columns:
+            return self
+        if self.columns and len(df) != len(self.codes[self.columns[0]]):
+            raise ValueError("new columns must have the same number of rows as the existing ones")
+
+        for col in new_columns:
+            self.codes[col], self.n_categories[col] = self.encode(df[col])
+            # Missing values (code -1 for mutual_information) are left out like in contingency_table
+            codes = self.codes[col]
+            self.entropies[col] = entropy(np.bincount(codes[codes >= 0], minlength=self.n_categories[col]))
+
+        columns = self.columns + new_columns
+        n_old = len(self.columns)
+        codes = np.column_stack([self.codes[col] for col in columns])
+        n_categories = np.array([self.n_categories[col] for col in columns])
+
+        # Only the pairs with at least one new column: k x n_old plus the new ones among themselves
+        pairs = [(i, j) for j in range(n_old, len(columns)) for i in range(j)]
+        if self.measure == "mutual_information":
+            batches = [pairs[k:k + self.batch_size] for k in range(0, len(pairs), self.batch_size)]
+            results = map_pair_batches(_mutual_info_pairs, batches, _init_worker, (codes, n_categories), self.n_jobs)
+            cells = [(value, value) for batch in results for value in batch]
+            diagonal = 0.0
+        else:
+            entropies = np.array([self.entropies[col] for col in columns])
+            batches = [(pairs[k:k + self.batch_size], self.measure, True)
+                       for k in range(0, len(pairs), self.batch_size)]
+            results = map_pair_batches(_nominal_pairs, batches, init_nominal_worker,
+                                       (codes, n_categories, entropies), self.n_jobs)
+            cells = [cell for batch in results for cell in batch]
+            diagonal = 1.0
+
+        scores = np.full((len(columns), len(columns)), diagonal)
+        scores[:n_old, :n_old] = self.scores
+        for (i, j), (ij, ji) in zip(pairs, cells):
+            scores[i, j] = ij
+            scores[j, i] = ji
+        self.scores = scores
+        self.columns = columns
+        return self
+
+    def drop_columns(self, columns):
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        idx = [self.columns.index(col) for col in columns]
+        self.scores = np.delete(np.delete(self.scores, idx, axis=0), idx, axis=1)
+        self.columns = [col for col in self.columns if col not in columns]
+        for col in columns:
+            del self.codes[col], self.n_categories[col], self.entropies[col]
+        return self
+
+    def to_frame(self):
+        scores = self.scores.copy()
+        if self.measure != "mutual_information":
+            # Invalid values and single valued columns are shown as 0, like association_matrix
+            scores[~np.isfinite(scores)] = 0.0
+            single_valued = [k for k, col in enumerate(self.columns) if self.n_categories[col] == 1]
+            scores[single_valued, :] = 0.0
+            scores[:, single_valued] = 0.0
+        return pd.DataFrame(scores, index=self.columns, columns=self.columns)
+
+    def pairs(self):
+        return select_vars(self.to_frame(), self.threshold)
+
+    def snapshot(self):
+        # Copy of the current state, the encodings are shared since they are never modified
+        other = copy.copy(self)
+        other.columns = list(self.columns)
+        other.codes = dict(self.codes)
+        other.n_categories = dict(self.n_categories)
+        other.entropies = dict(self.entropies)
+        other.scores = self.scores.copy()
+        return other
+
+    def drop_sequence(self):
+        return drop_sequence(self.to_frame(), self.threshold)
@@ -1,8 +1,36 @@
 from pathlib import Path
+import importlib.util
+import hashlib
+import inspect
+import json
+import ast
 import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 
-# Assuming project_root is already defined
-project_root = Path("..").resolve()
+# Found from the location of this file so paths resolve the same from notebooks and scripts
+project_root = Path(__file__).resolve().parent.parent.parent
+cache_dir = Path("data/interim/cache")
+# Part of every cache key, bump it to invalidate all cached outputs, e.g. after a change to a data
+# file or an installed package that the source hashes cannot see
+cache_version = 1
+
+# Strings pd.read_csv reads as missing values by default, given to the Polars readers so both
+# paths see the same nulls
+pandas_null_values = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                      "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+# Rows the Polars readers infer dtypes from, polars reads 100 by default and a full inference would
+# read the whole file once more before the streaming pass
+schema_rows = 10000
+
+
+def polars_csv_options(kwargs):
+    # pandas nulls and dtypes inferred from the first schema_rows rows. A column that stops being numeric
+    # after them fails with ComputeError, give its dtype in dtypes (e.g. {"snpId": pl.Utf8}) instead of
+    # inferring the schema from every row with infer_schema_length=None
+    return {"null_values": pandas_null_values, "infer_schema_length": schema_rows, **kwargs}
 
 def read_csv(relative_path, **kwargs):
     """
@@ -20,3 +48,252 @@ def read_csv(relative_path, **kwargs):
 def read_pickle(relative_path):
     full_path = project_root / relative_path
     return pd.read_pickle(full_path)
+
+def scan_csv(relative_path, **kwargs):
+    """
+    Lazily scan a CSV file with the project root prepended, nothing is read until collect.
+    Args:
+        relative_path (str or Path): The relative path from the project root.
+        **kwargs: Additional arguments to pass to pl.scan_csv (separator, dtypes, ...), null_values
+            default to the pandas ones and infer_schema_length to schema_rows, see polars_csv_options.
+    Returns:
+        LazyFrame: Polars LazyFrame over the CSV file.
+    """
+    full_path = project_root / relative_path
+    return pl.scan_csv(full_path, **polars_csv_options(kwargs))
+
+def uninformative_columns(lf):
+    """
+    Find the columns cleaning() would drop (more than 50% nulls, a single unique value
+    or lastEval) in one streaming pass, keeping only counts and min/max per column.
+    Args:
+        lf (LazyFrame): LazyFrame returned by scan_csv.
+    Returns:
+        list: Names of the columns to drop.
+    """
+    columns = lf.columns
+    stats = lf.select(
+        [pl.len().alias("len")]
+        + [pl.col(col).null_count().alias(f"null_{i}") for i, col in enumerate(columns)]
+        + [pl.col(col).min().alias(f"min_{i}") for i, col in enumerate(columns)]
+        + [pl.col(col).max().alias(f"max_{i}") for i, col in enumerate(columns)]
+    ).collect(streaming=True).row(0, named=True)
+
+    n_rows = stats["len"]
+    # Nothing to measure in an empty file, every column would look all null
+    if n_rows == 0:
+        return []
+    columns_to_remove = []
+    for i, col in enumerate(columns):
+        null_count = stats[f"null_{i}"]
+        # A single unique value is either an all null column or a column without nulls where min == max
+        single_valued = null_count == n_rows or (null_count == 0 and stats[f"min_{i}"] == stats[f"max_{i}"])
+        if null_count > n_rows * 0.5 or single_valued or col == "lastEval":
+            columns_to_remove.append(col)
+    return columns_to_remove
+
+def collect_informative(lf, prune=True):
+    # Informative columns of a scan, read with the streaming engine
+    if prune:
+        lf = lf.drop(uninformative_columns(lf))
+    return lf.collect(streaming=True)
+
+def read_csv_streaming(relative_path, prune=True, to_pandas=True, **kwargs):
+    """
+    Read a raw CSV file in bounded memory: the columns cleaning() would drop are
+    pruned inside the scan and the rest is collected with the streaming engine.
+    Args:
+        relative_path (str or Path): The relative path from the project root.
+        prune (bool): Drop the uninformative columns before reading them.
+        to_pandas (bool): Return a pandas DataFrame instead of a Polars one.
+        **kwargs: Additional arguments to pass to pl.scan_csv (separator, dtypes, ...).
+    Returns:
+        DataFrame: Loaded DataFrame with only the informative columns.
+    """
+    try:
+        df = collect_informative(scan_csv(relative_path, **kwargs), prune)
+    except pl.exceptions.ComputeError:
+        # A column changed type after the inferred rows, only then the schema is inferred from every row
+        if "infer_schema_length" in kwargs:
+            raise
+        df = collect_informative(scan_csv(relative_path, infer_schema_length=None, **kwargs), prune)
+    return df.to_pandas() if to_pandas else df
+
+def iter_csv_batches(relative_path, columns=None, batch_size=50000, **kwargs):
+    """
+    Iterate over a CSV file in batches of rows, only one batch is in memory at a time.
+    Args:
+        relative_path (str or Path): The relative path from the project root.
+        columns (list): Columns to read, e.g. the ones kept by uninformative_columns.
+        batch_size (int): Number of rows per batch.
+        **kwargs: Additional arguments to pass to pl.read_csv_batched.
+    Yields:
+        DataFrame: Polars DataFrame with the next batch of rows.
+    """
+    full_path = project_root / relative_path
+    reader = pl.read_csv_batched(full_path, columns=columns, batch_size=batch_size, **polars_csv_options(kwargs))
+    batches = reader.next_batches(1)
+    while batches:
+        yield from batches
+        batches = reader.next_batches(1)
+
+def file_hash(relative_path, chunk_size=1 << 20):
+    """
+    Hash the content of a file, reading it in chunks.
+    Args:
+        relative_path (str or Path): The relative path from the project root.
+        chunk_size (int): Number of bytes read at a time.
+    Returns:
+        str: Hex digest of the file content.
+    """
+    full_path = project_root / relative_path
+    digest = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def frame_hash(df):
+    """
+    Hash the content of a DataFrame.
+    Args:
+        df (DataFrame): pandas DataFrame.
+    Returns:
+        str: Hex digest of the DataFrame.
+    """
+    # Always the content: df.attrs follows drop, filtering, assign... so a key kept there would also
+    # be the key of every frame derived from a cached output
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(col) for col in df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+def imported_modules(path, package):
+
+    # Names of the modules imported anywhere in a source file, imports inside functions included
+    names = []
+    for node in ast.walk(ast.parse(Path(path).read_text())):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            base = importlib.util.resolve_name("." * node.level + (node.module or ""), package) if node.level \
+                else node.module
+            # "from package import module" imports a module, "from module import name" does not
+            names += [base] + [f"{base}.{alias.name}" for alias in node.names]
+    return names
+
+def local_modules(module):
+    """
+    Source files of a module and of every project module it imports, directly or through other
+    project modules. Installed packages are left out.
+    Args:
+        module (module): Module whose dependencies are collected, e.g. inspect.getmodule(func).
+    Returns:
+        list: Sorted paths of the project source files.
+    """
+    root = project_root.resolve()
+    found = {}
+    stack = [(Path(module.__file__).resolve(), module.__package__ or "")]
+    while stack:
+        path, package = stack.pop()
+        if path in found or root not in path.parents:
+            continue
+        found[path] = package
+        for name in imported_modules(path, package):
+            try:
+                spec = importlib.util.find_spec(name)
+            except (ImportError, ValueError):
+                continue
+            if spec is not None and spec.origin and spec.origin.endswith(".py"):
+                stack.append((Path(spec.origin).resolve(), name if spec.submodule_search_locations else spec.parent))
+    return sorted(found)
+
+def code_version(code):
+    """
+    Hash the source of the modules defining some functions and of the project modules they import.
+    Args:
+        code (list): Functions or classes of a stage.
+    Returns:
+        str: Hex digest, changes with cache_version too.
+    """
+    digest = hashlib.sha256(str(cache_version).encode())
+    paths = sorted({path for func in code for path in local_modules(inspect.getmodule(func))})
+    for path in paths:
+        digest.update(str(path.relative_to(project_root.resolve())).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+def cache_key(inputs, params=None, code=None):
+    """
+    Build the cache key of a stage from its inputs, parameters and code version.
+    Args:
+        inputs (list): Relative paths of input files and/or input DataFrames.
+        params (dict): Parameters of the stage, must be JSON serializable.
+        code (list): Functions of the stage, the source of their modules and of the project modules
+            these import is the code version, see code_version.
+    Returns:
+        str: Hex digest used to name the cached file.
+    """
+    digest = hashlib.sha256()
+    for item in inputs:
+        digest.update((frame_hash(item) if isinstance(item, pd.DataFrame) else file_hash(item)).encode())
+    digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    digest.update(code_version(code or []).encode())
+    return digest.hexdigest()[:16]
+
+def write_cached(df, full_path, fmt="ipc"):
+    """
+    Write a DataFrame as uncompressed Arrow IPC (memory mappable) or Parquet,
+    categories are stored with dictionary encoding.
+    """
+    full_path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    tmp_path = full_path.with_suffix(full_path.suffix + ".tmp")
+    if fmt == "ipc":
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+    else:
+        pq.write_table(table, tmp_path)
+    # Rename at the end so an interrupted write never looks like a valid entry
+    tmp_path.replace(full_path)
+
+def read_cached(full_path, fmt="ipc", to_pandas=True):
+    """
+    Memory-map a cached file, with to_pandas=False the Arrow table is returned without copies.
+    """
+    if fmt == "ipc":
+        table = feather.read_table(full_path, memory_map=True)
+    else:
+        table = pq.read_table(full_path, memory_map=True)
+    return table.to_pandas() if to_pandas else table
+
+def load_or_compute(stage_name, compute, inputs, params=None, code=None, fmt="ipc"):
+    """
+    Return the cached output of a stage or compute and cache it under data/interim/cache.
+    Args:
+        stage_name (str): Name of the stage, used as prefix of the cached file.
+        compute (callable): Function without arguments returning the stage DataFrame.
+        inputs (list): Relative paths of input files and/or input DataFrames.
+        params (dict): Parameters of the stage.
+        code (list): Functions of the stage, e.g. [cleaning].
+        fmt (str): "ipc" (Arrow IPC) or "parquet".
+    Returns:
+        DataFrame: Output of the stage.
+    Example:
+        raw = "data/raw/cancermama_clinvarmain.csv"
+        df = load_or_compute("cancermama_clinvarmain_clean",
+                             lambda: cleaning(read_csv(raw, sep="\\t"), "cancermama_clinvarmain"),
+                             inputs=[raw], params={"sep": "\\t"}, code=[cleaning])
+    """
+    if fmt not in ["ipc", "parquet"]:
+        raise ValueError("invalid fmt, valid options are ipc and parquet")
+
+    key = cache_key(inputs, params, code)
+    extension = "arrow" if fmt == "ipc" else "parquet"
+    full_path = project_root / cache_dir / f"{stage_name}_{key}.{extension}"
+
+    if full_path.exists():
+        df = read_cached(full_path, fmt)
+    else:
+        df = compute()
+        write_cached(df, full_path, fmt)
+    return df
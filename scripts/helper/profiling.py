@@ -0,0 +1,206 @@
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+import contextlib
+import threading
+import cProfile
+import time
+import json
+import os
+import psutil
+import pandas as pd
+
+# Stage timings are appended to log_dir / log_name as JSON lines, off unless PIPELINE_PROFILING=1
+# or configure(enable=True) since every record costs a sampling thread and a file write
+log_dir = Path(__file__).resolve().parent.parent.parent / "results" / "logs"
+log_name = "stages.jsonl"
+enabled = os.environ.get("PIPELINE_PROFILING", "0") == "1"
+# "cprofile" or "pyinstrument" to also capture a profile of every stage in log_dir / "profiles"
+profiler = os.environ.get("PIPELINE_PROFILER") or None
+# Bytes of the inputs and output of every stage, off by default since memory_usage(deep=True)
+# walks every string of a frame, PIPELINE_PROFILING_BYTES=1 turns it on
+measure_bytes = os.environ.get("PIPELINE_PROFILING_BYTES", "0") == "1"
+
+_state = threading.local()
+
+
+def configure(enable=None, capture=None, directory=None, sizes=None):
+    """
+    Change the instrumentation settings of the running process.
+    Args:
+        enable (bool): Write stage records.
+        capture (str): "cprofile", "pyinstrument" or "" to stop capturing profiles.
+        directory (str or Path): Directory of the JSON-lines log and the profiles.
+        sizes (bool): Also record the bytes of the inputs and outputs.
+    """
+    global enabled, profiler, log_dir, measure_bytes
+    if enable is not None:
+        enabled = enable
+    if capture is not None:
+        profiler = capture or None
+    if directory is not None:
+        log_dir = Path(directory)
+    if sizes is not None:
+        measure_bytes = sizes
+
+
+def describe(obj):
+
+    # Shape of arrays and frames, length of lists, the parts of tuples returned by a stage
+    if hasattr(obj, "shape"):
+        return list(obj.shape)
+    if isinstance(obj, tuple):
+        return [describe(item) for item in obj]
+    if isinstance(obj, (list, dict)):
+        return [len(obj)]
+    return None
+
+
+def nbytes(obj):
+
+    # Bytes held by frames (strings and categories included), arrays and sparse matrices
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    if hasattr(obj, "estimated_size"):
+        return int(obj.estimated_size())
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    if hasattr(obj, "data") and hasattr(obj, "indices") and hasattr(obj, "indptr"):
+        return int(obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes)
+    if isinstance(obj, tuple):
+        return sum(nbytes(item) or 0 for item in obj)
+    return None
+
+
+class PeakMemory:
+    """
+    Resident set size sampled from a background thread while a stage runs.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.start_rss = self.peak_rss = self.process.memory_info().rss
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.end_rss = self.process.memory_info().rss
+        self.peak_rss = max(self.peak_rss, self.end_rss)
+
+
+@contextlib.contextmanager
+def capture_profile(stage):
+
+    # Profile of the outermost stage only, nested profilers are not supported
+    if profiler is None or getattr(_state, "depth", 0) > 1:
+        yield None
+        return
+    profile_dir = log_dir / "profiles"
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    stem = profile_dir / f"{stage}_{datetime.now():%Y%m%d_%H%M%S_%f}"
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        capture = Profiler()
+        capture.start()
+        # Stopped and saved even when the stage raises, a profiler left installed breaks the next stage
+        try:
+            yield str(stem) + ".html"
+        finally:
+            capture.stop()
+            Path(str(stem) + ".html").write_text(capture.output_html())
+    else:
+        capture = cProfile.Profile()
+        capture.enable()
+        try:
+            yield str(stem) + ".prof"
+        finally:
+            capture.disable()
+            capture.dump_stats(str(stem) + ".prof")
+
+
+def write_record(record):
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with open(log_dir / log_name, "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+@contextlib.contextmanager
+def profile_stage(stage, inputs=None):
+    """
+    Record wall time, CPU time, peak RSS and the input/output shapes (and bytes with measure_bytes)
+    of a block of code.
+    The block can set the "output" key of the yielded dictionary to record its output shape.
+    Failed blocks are logged too, with the type of the exception in "error".
+    Args:
+        stage (str): Name of the stage in the log.
+        inputs (list): Inputs of the stage, only their shapes and sizes are logged.
+    """
+    info = {"output": None}
+    if not enabled:
+        yield info
+        return
+    _state.depth = getattr(_state, "depth", 0) + 1
+    start = datetime.now()
+    wall, cpu = time.perf_counter(), time.process_time()
+    memory = PeakMemory()
+    profile_path, error = None, None
+    try:
+        with memory, capture_profile(stage) as profile_path:
+            yield info
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        _state.depth -= 1
+        write_record({
+            "stage": stage,
+            "start": start.isoformat(),
+            "wall_s": time.perf_counter() - wall,
+            "cpu_s": time.process_time() - cpu,
+            "rss_start_mb": memory.start_rss / 2 ** 20,
+            "peak_rss_mb": memory.peak_rss / 2 ** 20,
+            "rss_end_mb": memory.end_rss / 2 ** 20,
+            "input_shapes": [describe(obj) for obj in inputs or []],
+            "output_shape": describe(info["output"]),
+            "input_bytes": [nbytes(obj) for obj in inputs or []] if measure_bytes else None,
+            "output_bytes": nbytes(info["output"]) if measure_bytes else None,
+            "pid": os.getpid(),
+            "profile": profile_path,
+            "error": error,
+        })
+
+
+def profiled(stage=None):
+    """
+    Decorator logging every call of a pipeline entry point with profile_stage.
+    Args:
+        stage (str): Name in the log, the qualified name of the function by default.
+    """
+    def decorator(func):
+        name = stage or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name, list(args) + list(kwargs.values())) as info:
+                info["output"] = func(*args, **kwargs)
+            return info["output"]
+        return wrapper
+    return decorator
+
+
+def read_log(path=None):
+    # Stage records as a DataFrame, e.g. to compare the stages of two data releases
+    return pd.read_json(path or log_dir / log_name, lines=True)
@@ -0,0 +1,230 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.model_selection import RepeatedStratifiedKFold
+from sklearn.metrics import f1_score, accuracy_score, precision_score, recall_score
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
+from threadpoolctl import threadpool_limits
+from pathlib import Path
+import pandas as pd
+import numpy as np
+import tempfile
+import shutil
+import time
+import os
+
+from helper.profiling import profiled
+
+# Metrics computed on the predictions of every fold, f1 is the score the notebooks optimize
+metrics = {
+    "f1": f1_score,
+    "accuracy": accuracy_score,
+    "precision": lambda y_true, y_pred: precision_score(y_true, y_pred, zero_division=0),
+    "recall": lambda y_true, y_pred: recall_score(y_true, y_pred, zero_division=0),
+}
+
+# Hyperopt samples these as floats
+integer_params = {"n_estimators", "max_depth", "min_samples_leaf", "min_samples_split", "degree"}
+
+
+def encode_features(X, dtype=np.float64):
+    """
+    Encode a feature frame once into one numeric matrix.
+    Categorical and object columns become their category codes (NaN for missing values) and are
+    marked as categorical for XGBoost, the other models see the codes as ordinal values.
+    Args:
+        X (DataFrame or ndarray): Features, already scaled or binary encoded where needed.
+        dtype: Type of the matrix, float64 keeps the values the notebooks give to SVC.
+    Returns:
+        tuple: C-contiguous matrix and the XGBoost feature type ("c" or "q") of every column.
+    """
+    if not isinstance(X, pd.DataFrame):
+        X = np.asarray(X, dtype=dtype)
+        return np.ascontiguousarray(X), ["q"] * X.shape[1]
+    matrix = np.empty(X.shape, dtype=dtype)
+    feature_types = []
+    for j, (_, col) in enumerate(X.items()):
+        if isinstance(col.dtype, pd.CategoricalDtype) or col.dtype == object:
+            codes = col.astype("category").cat.codes.to_numpy()
+            matrix[:, j] = np.where(codes < 0, np.nan, codes)
+            feature_types.append("c")
+        else:
+            matrix[:, j] = col.to_numpy(dtype=dtype, na_value=np.nan)
+            feature_types.append("q")
+    return matrix, feature_types
+
+
+def make_model(model, params, n_threads=1, feature_types=None):
+    """
+    Build one of the notebook classifiers.
+    Args:
+        model (str): "xgboost", "random_forest" or "svc".
+        params (dict): Hyperparameters, integer ones sampled as floats are rounded.
+        n_threads (int): Threads of the model, SVC is single threaded.
+        feature_types (list): XGBoost type of every column, see encode_features.
+    Returns:
+        Estimator: Unfitted classifier.
+    """
+    params = {key: int(value) if key in integer_params else value for key, value in params.items()}
+    if model == "xgboost":
+        # Imported here so the UMAP search, which shares this module through the optimizer, runs without XGBoost
+        import xgboost as xgb
+        categorical = feature_types is not None and "c" in feature_types
+        return xgb.XGBClassifier(objective="binary:logistic", eval_metric="auc", tree_method="hist",
+                                 enable_categorical=categorical, feature_types=feature_types if categorical else None,
+                                 n_jobs=n_threads, **params)
+    if model == "random_forest":
+        return RandomForestClassifier(**{"random_state": 42, **params}, n_jobs=n_threads)
+    if model == "svc":
+        return SVC(**params)
+    raise ValueError("invalid model, valid options are xgboost, random_forest and svc")
+
+
+# Feature matrix, labels and thread budget of each worker process
+_features = None
+_labels = None
+_feature_types = None
+_threads = 1
+
+
+def _init_worker(path, labels, feature_types, threads):
+    global _features, _labels, _feature_types, _threads
+    # Every worker maps the same file instead of receiving a copy of the matrix
+    _features = np.load(path, mmap_mode="r")
+    _labels = labels
+    _feature_types = feature_types
+    _threads = threads
+    # BLAS and OpenMP pools of numpy, scikit-learn and XGBoost share the cores with the other workers
+    threadpool_limits(threads)
+
+
+def fit_fold(features, labels, feature_types, threads, job):
+    """
+    Fit one candidate on the training rows of one fold and score it on the held out rows.
+    Args:
+        features (ndarray): Encoded feature matrix, possibly memory-mapped.
+        labels (ndarray): Binary labels.
+        feature_types (list): XGBoost type of every column.
+        threads (int): Threads given to the model.
+        job (tuple): (candidate, model, params, repeat, fold, train rows, test rows).
+    Returns:
+        dict: Candidate, model, repeat, fold, fit time and the metrics of the fold.
+    """
+    candidate, model, params, repeat, fold, train, test = job
+    estimator = make_model(model, params, threads, feature_types)
+    start = time.perf_counter()
+    estimator.fit(features[train], labels[train])
+    predictions = estimator.predict(features[test])
+    result = {"candidate": candidate, "model": model, "repeat": repeat, "fold": fold,
+              "fit_seconds": time.perf_counter() - start}
+    for name, metric in metrics.items():
+        result[name] = metric(labels[test], predictions)
+    return result
+
+
+def _fit_fold(job):
+    return fit_fold(_features, _labels, _feature_types, _threads, job)
+
+
+class CrossValidator:
+    """
+    Repeated stratified cross-validation of several classifiers over one process pool.
+    The features are encoded once and saved as a .npy file that every worker memory-maps,
+    (candidate x repeat x fold) jobs are spread over the workers and their metrics are
+    yielded as soon as each fold finishes. The pool is kept between calls, e.g. for the trials
+    of a hyperparameter search, until close() is called.
+    """
+
+    def __init__(self, X, y, n_splits=10, n_repeats=1, random_state=42, n_jobs=None, threads_per_job=None,
+                 directory=None):
+        self.features, self.feature_types = encode_features(X)
+        self.labels = np.asarray(y)
+        # With n_repeats=1 the folds are those of StratifiedKFold(n_splits, shuffle=True, random_state)
+        cv = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state)
+        self.folds = [(i // n_splits, i % n_splits, train, test)
+                      for i, (train, test) in enumerate(cv.split(self.features, self.labels))]
+        # Workers x threads per worker never exceeds the number of cores
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.threads_per_job = threads_per_job or max(1, (os.cpu_count() or 1) // self.n_jobs)
+        self.directory = Path(directory) if directory is not None else None
+        self.path = None
+        self.executor = None
+
+    def pool(self):
+        if self.executor is None:
+            directory = self.directory or Path(tempfile.mkdtemp(prefix="cross_validation_"))
+            directory.mkdir(parents=True, exist_ok=True)
+            self.path = directory / "features.npy"
+            np.save(self.path, self.features)
+            self.executor = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+                                                initargs=(str(self.path), self.labels, self.feature_types,
+                                                          self.threads_per_job))
+        return self.executor
+
+    def jobs(self, candidates):
+        # candidates: {name: (model, params)}
+        return [(name, model, params, repeat, fold, train, test)
+                for name, (model, params) in candidates.items() for repeat, fold, train, test in self.folds]
+
+    def iter_results(self, candidates):
+        """
+        Run every fold of every candidate.
+        Args:
+            candidates (dict): Name of each candidate to a (model, params) pair, see make_model.
+        Yields:
+            dict: Metrics of one fold as soon as it finishes, see fit_fold.
+        """
+        jobs = self.jobs(candidates)
+        if self.n_jobs == 1:
+            for job in jobs:
+                yield fit_fold(self.features, self.labels, self.feature_types, self.threads_per_job, job)
+            return
+        futures = [self.pool().submit(_fit_fold, job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+    @profiled("CrossValidator.evaluate")
+    def evaluate(self, candidates, callback=None):
+        """
+        Run every fold of every candidate and collect the metrics.
+        Args:
+            candidates (dict): Name of each candidate to a (model, params) pair, see make_model.
+            callback (callable): Called with the metrics of every fold as it finishes.
+        Returns:
+            DataFrame: One row per (candidate, repeat, fold), sorted.
+        """
+        results = []
+        for result in self.iter_results(candidates):
+            if callback is not None:
+                callback(result)
+            results.append(result)
+        return pd.DataFrame(results).sort_values(["candidate", "repeat", "fold"]).reset_index(drop=True)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.path is not None:
+            if self.directory is None:
+                shutil.rmtree(self.path.parent, ignore_errors=True)
+            else:
+                self.path.unlink(missing_ok=True)
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def summarize(results):
+    # Mean and standard deviation of every metric per candidate over all folds and repeats
+    return results.groupby(["candidate", "model"])[list(metrics)].agg(["mean", "std"])
+
+# Example usage:
+# candidates = {"xgb": ("xgboost", {"n_estimators": 100, "max_depth": 4}),
+#               "rf": ("random_forest", {"n_estimators": 200}),
+#               "svc": ("svc", {"C": 6.68, "kernel": "rbf", "gamma": 0.053})}
+# with CrossValidator(X_train, y_train, n_splits=10, n_repeats=3) as validator:
+#     results = validator.evaluate(candidates, callback=print)
+# summarize(results)
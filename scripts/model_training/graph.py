@@ -0,0 +1,286 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# torch and torch_geometric are imported inside the functions that need them, the array
+# construction works without them and importing model_training stays fast
+
+graph_path = Path("data/processed/hetero_graph.pt")
+
+
+def node_codes(col):
+    """
+    Integer code of every row and the distinct values in order of first appearance.
+    Categoricals from the cleaner are factorized on their codes, no strings are compared.
+    Args:
+        col (Series): Column naming the node of every row.
+    Returns:
+        tuple: Codes (-1 for missing values) and the node names.
+    """
+    codes, names = pd.factorize(col)
+    return codes.astype(np.int64), np.asarray(names)
+
+
+def first_rows(codes, n_nodes):
+    # Row of the first occurrence of every node, like data[data["Gene"] == gene].iloc[0]
+    first = np.full(n_nodes, -1, dtype=np.int64)
+    valid = np.flatnonzero(codes >= 0)
+    nodes, idx = np.unique(codes[valid], return_index=True)
+    first[nodes] = valid[idx]
+    return first
+
+
+def feature_matrix(df, columns):
+    # float32 node features, categoricals as their codes and missing values as 0
+    if not columns:
+        return np.ones((len(df), 1), dtype=np.float32)
+    matrix = np.empty((len(df), len(columns)), dtype=np.float32)
+    for j, col in enumerate(columns):
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object:
+            values = values.astype("category").cat.codes.astype(np.float32)
+        matrix[:, j] = values.to_numpy(dtype=np.float32, na_value=0.0)
+    return matrix
+
+
+def pair_edges(group_codes, member_codes, n_nodes):
+    """
+    Edges between every two distinct nodes that share a group, in both directions.
+    Args:
+        group_codes (ndarray): Group of every row, -1 for missing.
+        member_codes (ndarray): Node of every row, -1 for missing.
+        n_nodes (int): Number of nodes.
+    Returns:
+        ndarray: edge_index of shape (2, E), each pair once.
+    """
+    valid = (group_codes >= 0) & (member_codes >= 0)
+    members = pd.DataFrame({"group": group_codes[valid], "node": member_codes[valid]}).drop_duplicates()
+    # Self join on the group, a vectorized version of the nested loop over the genes of each region
+    pairs = members.merge(members, on="group", suffixes=("_src", "_dst"))
+    src, dst = pairs["node_src"].to_numpy(), pairs["node_dst"].to_numpy()
+    keys = np.unique(src[src != dst] * n_nodes + dst[src != dst])
+    return np.stack([keys // n_nodes, keys % n_nodes])
+
+
+def build_graph_arrays(df, repeats=None, gene="Gene", region="cytogenetic", gene_features=("x_position", "y_position"),
+                       gene_label="gen_label", variant_features=("blockSizes",), variant_label="bin_class"):
+    """
+    Node features, labels and edge_index arrays of the gene-variant-repeat graph of the GNN notebook.
+    Every row of df is a variant node linked to its gene, genes sharing a cytogenetic region are
+    linked to each other and, with repeats, genes are linked to the repeat kinds they contain.
+    Args:
+        df (DataFrame): Merged frame, one row per variant.
+        repeats (DataFrame): parse_dataframe output (gene, kind, position, counts), optional.
+        gene (str): Column with the gene of every variant.
+        region (str): Column of the cytogenetic region, None to leave out the gene-gene edges.
+        gene_features (tuple): Columns of the gene features, taken from the first row of each gene.
+        gene_label (str): Column of the gene labels.
+        variant_features (tuple): Columns of the variant features.
+        variant_label (str): Column of the variant labels.
+    Returns:
+        dict: {"nodes": {type: {"x", "y", "names"}}, "edges": {(src, relation, dst): {"edge_index",
+            "edge_attr"}}}, every array numpy, edge_index int64 of shape (2, E).
+    """
+    gene_codes, genes = node_codes(df[gene])
+    first = first_rows(gene_codes, len(genes))
+    n_variants = len(df)
+
+    nodes = {
+        "gene": {"x": feature_matrix(df, list(gene_features))[first], "names": genes,
+                 "y": df[gene_label].to_numpy()[first].astype(np.int64) if gene_label else None},
+        "variant": {"x": feature_matrix(df, list(variant_features)), "names": None,
+                    "y": df[variant_label].to_numpy().astype(np.int64) if variant_label else None},
+    }
+
+    # One edge per variant row, variants without a gene are left unconnected
+    valid = gene_codes >= 0
+    gene_variant = np.stack([gene_codes[valid], np.arange(n_variants)[valid]])
+    edges = {
+        ("gene", "interacts_with", "variant"): {"edge_index": gene_variant, "edge_attr": None},
+        ("variant", "rev_interacts_with", "gene"): {"edge_index": gene_variant[::-1].copy(), "edge_attr": None},
+    }
+    if region is not None:
+        region_codes, _ = node_codes(df[region])
+        edges[("gene", "connected_to", "gene")] = {"edge_index": pair_edges(region_codes, gene_codes, len(genes)),
+                                                   "edge_attr": None}
+
+    if repeats is not None:
+        # Repeat genes matched to the gene nodes case-insensitively, like the merge of the labels
+        gene_index = pd.Index(pd.Series(genes, dtype=object).astype(str).str.lower())
+        repeat_genes = repeats["gene"].astype("category")
+        categories = gene_index.get_indexer(repeat_genes.cat.categories.astype(str).str.lower())
+        repeat_gene_codes = np.append(categories, -1)[repeat_genes.cat.codes.to_numpy()]
+        kind_codes, kinds = node_codes(repeats["kind"])
+        counts = repeats["counts"].to_numpy(dtype=np.float32)
+
+        # Counts summed per (gene, kind), the edge weight of the gene-repeat edges
+        valid = (repeat_gene_codes >= 0) & (kind_codes >= 0)
+        keys = repeat_gene_codes[valid] * len(kinds) + kind_codes[valid]
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        weights = np.bincount(inverse, weights=counts[valid]).astype(np.float32)
+        gene_repeat = np.stack([unique_keys // len(kinds), unique_keys % len(kinds)])
+
+        nodes["repeat"] = {"x": np.eye(len(kinds), dtype=np.float32), "names": kinds, "y": None}
+        edges[("gene", "has_repeat", "repeat")] = {"edge_index": gene_repeat, "edge_attr": weights[:, None]}
+        edges[("repeat", "rev_has_repeat", "gene")] = {"edge_index": gene_repeat[::-1].copy(),
+                                                       "edge_attr": weights[:, None]}
+    return {"nodes": nodes, "edges": edges}
+
+
+def to_hetero_data(arrays):
+    """
+    HeteroData sharing the memory of the arrays of build_graph_arrays.
+    Args:
+        arrays (dict): Output of build_graph_arrays.
+    Returns:
+        HeteroData: Graph with x and y per node type and edge_index (and edge_attr) per relation.
+    """
+    import torch
+    from torch_geometric.data import HeteroData
+
+    data = HeteroData()
+    for node_type, node in arrays["nodes"].items():
+        data[node_type].x = torch.from_numpy(node["x"])
+        if node["y"] is not None:
+            data[node_type].y = torch.from_numpy(node["y"])
+    for edge_type, edge in arrays["edges"].items():
+        data[edge_type].edge_index = torch.from_numpy(np.ascontiguousarray(edge["edge_index"]))
+        if edge["edge_attr"] is not None:
+            data[edge_type].edge_attr = torch.from_numpy(edge["edge_attr"])
+    return data
+
+
+def build_graph(df, repeats=None, **kwargs):
+    # HeteroData straight from the frames, see build_graph_arrays for the options
+    return to_hetero_data(build_graph_arrays(df, repeats, **kwargs))
+
+
+def save_graph(data, path=graph_path):
+    # The zip format of torch.save is what lets load_graph map the tensors instead of reading them
+    import torch
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(data, path)
+    return path
+
+
+def load_graph(path=graph_path, mmap=True):
+    """
+    Load a graph saved by save_graph.
+    Args:
+        path (str or Path): File written by save_graph.
+        mmap (bool): Map the tensor storages from the file, pages are read when first used.
+    Returns:
+        HeteroData: The saved graph.
+    """
+    import torch
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"No data file found at {path}")
+    return torch.load(path, mmap=mmap, weights_only=False)
+
+
+def node_loss(out, batch, node_type, n_seeds=None):
+    import torch.nn.functional as F
+    # With neighbour sampling only the first n_seeds nodes are the ones the batch was sampled for
+    n_seeds = n_seeds or batch[node_type].num_nodes
+    return F.cross_entropy(out[node_type][:n_seeds], batch[node_type].y[:n_seeds])
+
+
+def train_model(model, data, mode="full", epochs=100, lr=0.001, weight_decay=0.0, target="gene", train_mask=None,
+                num_neighbors=(15, 10), batch_size=512, num_workers=0, seed=2024):
+    """
+    Train a heterogeneous GNN, e.g. GraphSAGEWithAttention of the GNN notebook.
+    Args:
+        model (Module): Takes (x_dict, edge_index_dict) and returns logits per node type.
+        data (HeteroData): Graph from build_graph or load_graph.
+        mode (str): "full" trains on the whole graph at once with the loss of every labelled node
+            type as in the notebook, "neighbor" trains on mini-batches of target nodes with their
+            sampled neighbourhoods, so the memory used depends on batch_size and num_neighbors
+            instead of the size of the graph.
+        epochs (int): Passes over the training nodes.
+        lr (float): Adam learning rate.
+        weight_decay (float): Adam weight decay.
+        target (str): Node type whose labels are learnt in "neighbor" mode.
+        train_mask (Tensor): Boolean mask of the training target nodes, all of them by default.
+        num_neighbors (tuple): Neighbours sampled per node at each layer, -1 for all of them.
+        batch_size (int): Target nodes per mini-batch.
+        num_workers (int): Processes preparing the mini-batches.
+        seed (int): Seed of the sampling and of the lazy parameter initialisation.
+    Returns:
+        list: Mean training loss of every epoch.
+    """
+    import torch
+    if mode not in ["full", "neighbor"]:
+        raise ValueError("invalid mode, valid options are full and neighbor")
+    torch.manual_seed(seed)
+
+    if mode == "full":
+        batches = [data]
+        labelled = [node_type for node_type in data.node_types if "y" in data[node_type]]
+    else:
+        from torch_geometric.loader import NeighborLoader
+        # Needs pyg-lib or torch-sparse for the sampling
+        input_nodes = (target, train_mask) if train_mask is not None else target
+        batches = NeighborLoader(data, num_neighbors=list(num_neighbors), input_nodes=input_nodes,
+                                 batch_size=batch_size, shuffle=True, num_workers=num_workers)
+
+    # Lazy layers such as SAGEConv((-1, -1), ...) get their shapes from a first forward pass
+    with torch.no_grad():
+        first = next(iter(batches))
+        model(first.x_dict, first.edge_index_dict)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+
+    history = []
+    model.train()
+    for _ in range(epochs):
+        total, n_batches = 0.0, 0
+        for batch in batches:
+            optimizer.zero_grad()
+            out = model(batch.x_dict, batch.edge_index_dict)
+            if mode == "full":
+                loss = sum(node_loss(out, batch, node_type) for node_type in labelled)
+            else:
+                loss = node_loss(out, batch, target, batch[target].batch_size)
+            loss.backward()
+            optimizer.step()
+            total += float(loss)
+            n_batches += 1
+        history.append(total / n_batches)
+    return history
+
+
+def predict(model, data, target="gene", mode="full", num_neighbors=(-1, -1), batch_size=4096):
+    """
+    Predicted class of every target node.
+    Args:
+        model (Module): Trained model.
+        data (HeteroData): Graph to predict on.
+        target (str): Node type to predict.
+        mode (str): "full" or "neighbor", the latter in batches of target nodes like train_model.
+        num_neighbors (tuple): Neighbours used per layer in "neighbor" mode, all of them by default.
+        batch_size (int): Target nodes per batch in "neighbor" mode.
+    Returns:
+        Tensor: Class of every target node.
+    """
+    import torch
+    model.eval()
+    with torch.no_grad():
+        if mode == "full":
+            return model(data.x_dict, data.edge_index_dict)[target].argmax(dim=1)
+        from torch_geometric.loader import NeighborLoader
+        loader = NeighborLoader(data, num_neighbors=list(num_neighbors), input_nodes=target,
+                                batch_size=batch_size, shuffle=False)
+        predictions = []
+        for batch in loader:
+            out = model(batch.x_dict, batch.edge_index_dict)
+            predictions.append(out[target][:batch[target].batch_size].argmax(dim=1))
+        return torch.cat(predictions)
+
+# Example usage:
+# graph = build_graph(merged_df, repeats=parse_dataframe(upgenevsrep))
+# save_graph(graph)
+# graph = load_graph()  # tensors memory-mapped from data/processed/hetero_graph.pt
+# model = GraphSAGEWithAttention(64, 32, 3, 2, num_gene_classes, num_variant_classes, F.gelu)
+# losses = train_model(model, graph, mode="neighbor", num_neighbors=(15, 10), batch_size=256, epochs=20)
+# gene_classes = predict(model, graph, mode="neighbor")
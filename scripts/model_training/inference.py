@@ -0,0 +1,65 @@
+from sklearn.neighbors import NearestNeighbors
+from pathlib import Path
+import numpy as np
+import joblib
+
+model_dir = Path("./models/trained_models")
+
+
+class ClusterPredictor:
+    """
+    Assign new points to the clusters of a pipeline saved by UMAPHDBSCANOptimizer.save_models
+    without refitting. The models are loaded once with their arrays memory-mapped, new batches
+    are embedded with umap.transform and get the majority label of their nearest neighbours in
+    the reference embedding the HDBSCAN model was fitted on.
+    """
+
+    def __init__(self, pipeline_name, directory=model_dir, n_neighbors=15, max_distance=None, mmap_mode="r"):
+        directory = Path(directory)
+        self.umap_model = joblib.load(directory / f"umap_{pipeline_name}.sav", mmap_mode=mmap_mode)
+        self.clusterer = joblib.load(directory / f"hdbscan_{pipeline_name}.sav", mmap_mode=mmap_mode)
+        # The UMAP model keeps the training embedding, which is what HDBSCAN was fitted on
+        self.reference = self.umap_model.embedding_
+        self.labels = np.asarray(self.clusterer.labels_)
+        self.clusters = np.unique(self.labels)
+        # Points further than max_distance from every reference point are labelled as noise
+        self.max_distance = max_distance
+        self.n_neighbors = min(n_neighbors, len(self.reference))
+        self.index = NearestNeighbors(n_neighbors=self.n_neighbors).fit(self.reference)
+
+    def transform(self, batch):
+        return self.umap_model.transform(batch)
+
+    def assign(self, embedding):
+        """
+        Label embedded points by a vote of their nearest reference points.
+        Args:
+            embedding (ndarray): Points in the UMAP space, shape (n, n_components).
+        Returns:
+            tuple: Labels (-1 for noise) and the share of the neighbours that voted for them.
+        """
+        distances, indices = self.index.kneighbors(embedding)
+        neighbor_labels = np.searchsorted(self.clusters, self.labels[indices])
+        votes = np.zeros((len(embedding), len(self.clusters)))
+        np.add.at(votes, (np.arange(len(embedding))[:, None], neighbor_labels), 1)
+        winners = votes.argmax(axis=1)
+        labels = self.clusters[winners]
+        strengths = votes[np.arange(len(embedding)), winners] / self.n_neighbors
+        if self.max_distance is not None:
+            labels = np.where(distances[:, 0] > self.max_distance, -1, labels)
+        return labels, strengths
+
+    def predict(self, batch, return_strength=False):
+        labels, strengths = self.assign(self.transform(batch))
+        return (labels, strengths) if return_strength else labels
+
+    def predict_batches(self, batches, return_strength=False):
+        # Stream batches (e.g. chunks of ClinVar updates) through the clustering one at a time
+        for batch in batches:
+            yield self.predict(batch, return_strength)
+
+# Example usage:
+# predictor = ClusterPredictor("example_pipeline")
+# labels = predictor.predict(new_umap_df)
+# for labels in predictor.predict_batches(chunks):
+#     ...
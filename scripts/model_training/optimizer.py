@@ -1,77 +1,663 @@
 import umap
+import numba
 import numpy as np
-from sklearn.metrics import silhouette_score
-from hyperopt import hp, fmin, tpe, Trials, STATUS_OK
+from hyperopt import hp, fmin, tpe, Trials, STATUS_OK, space_eval
+from hyperopt import base
 from sklearn.cluster import HDBSCAN
+from sklearn.base import clone
+from sklearn.compose import ColumnTransformer
+from sklearn.metrics import f1_score
+from sklearn.model_selection import RepeatedStratifiedKFold, train_test_split
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import MinMaxScaler, OneHotEncoder, OrdinalEncoder, TargetEncoder
+from threadpoolctl import threadpool_limits
+from concurrent.futures import ProcessPoolExecutor
+from umap.umap_ import nearest_neighbors
+from collections import OrderedDict
+from pathlib import Path
+import scipy.sparse as sp
+import hashlib
+import multiprocessing
+import time
+from itertools import repeat
 import joblib
 import random 
+import os
+import pandas as pd
+
+from .scoring import score_clustering, scoring_modes
+from .study import StudyStore, insert_trials
+from .cross_validation import encode_features, make_model
+from helper.profiling import profiled
 
 random.seed(2024) 
 
+# Scores lie in [-1, 1], the loss of a trial pruned on a subsample is moved behind every trial
+# scored on all the rows
+pruned_penalty = 2.0
+
+# Optimizer copy living in each worker process of the parallel search
+_worker_optimizer = None
+
+
+def _init_worker(optimizer):
+    global _worker_optimizer
+    _worker_optimizer = optimizer
+
+
+def _evaluate(params, rung_scores=None):
+    return _worker_optimizer.evaluate(params, rung_scores)
+
+
+def numba_threads_started():
+    # numba's threading layer (e.g. TBB) is not fork safe once it has been started
+    try:
+        numba.threading_layer()
+        return True
+    except ValueError:
+        return False
+
+
+def plateau_reached(trials, patience):
+    # True when the best loss is more than patience trials old
+    losses = [trial['result']['loss'] for trial in trials.trials]
+    return patience is not None and len(losses) > 0 and len(losses) - 1 - int(np.argmin(losses)) >= patience
+
+
+def trial_result(record, score):
+    # Hyperopt result of a trial, the record keeps the raw score and the fraction it was scored on
+    fraction, pruned = record[5], record[4] != "rejected" and record[5] < 1.0
+    return {'loss': -score + (pruned_penalty if pruned else 0.0), 'status': STATUS_OK, 'score': score,
+            'fraction': fraction}
+
+
+def best_trial(trials, skip=0):
+    # Sampled values and score of the best trial scored on all the rows, pruned and rejected
+    # trials only count when no trial got that far. The first skip trials (e.g. the warm start
+    # ones of other studies) are left out
+    done = [trial for trial in trials.trials[skip:] if trial['result'].get('status') == STATUS_OK]
+    full = [trial for trial in done if trial['result'].get('fraction', 1.0) >= 1.0]
+    if not done:
+        return None, None
+    best = min(full or done, key=lambda trial: trial['result']['loss'])
+    params = {key: values[0] for key, values in best['misc']['vals'].items() if values}
+    return params, best['result'].get('score', -best['result']['loss'])
+
+
+def suggest_batch(domain, trials, n, rstate):
+    # TPE suggestions for n new trials from the finished ones, with their parameters
+    new_ids = trials.new_trial_ids(n)
+    trials.refresh()
+    new_trials = tpe.suggest(new_ids, domain, trials, rstate.integers(2 ** 31 - 1))
+    return new_trials, [base.spec_from_misc(trial['misc']) for trial in new_trials]
+
+
+def data_fingerprint(data):
+    # Hash of the values of a dense or sparse matrix, used in the embedding cache keys
+    digest = hashlib.blake2b(digest_size=16)
+    if sp.issparse(data):
+        data = data.tocsr()
+        for array in [data.data, data.indices, data.indptr]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+    else:
+        data = np.ascontiguousarray(np.asarray(data))
+        digest.update(str(data.dtype).encode())
+        digest.update(data.tobytes())
+    digest.update(str(data.shape).encode())
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of UMAP (embedding, model) pairs. When spill_dir is set, evicted embeddings
+    are saved as .npy files and loaded back on a later miss (without their model).
+    """
+
+    def __init__(self, max_size=8, spill_dir=None):
+        self.max_size = max_size
+        self.spill_dir = Path(spill_dir) if spill_dir is not None else None
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.spill_dir is not None and (self.spill_dir / f"{key}.npy").exists():
+            embedding = np.load(self.spill_dir / f"{key}.npy")
+            self.put(key, embedding, None)
+            return embedding, None
+        return None
+
+    def put(self, key, embedding, model):
+        self.entries[key] = (embedding, model)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            old_key, (old_embedding, _) = self.entries.popitem(last=False)
+            if self.spill_dir is not None:
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                np.save(self.spill_dir / f"{old_key}.npy", old_embedding)
+
+
 class UMAPHDBSCANOptimizer:
-    def __init__(self, data):
+    def __init__(self, data, cache_size=8, spill_dir=None, share_knn=False, scoring="silhouette",
+                 sample_size=2000, scoring_seed=2024, working_memory=None, prune_infeasible=True,
+                 halving=False, eta=3, min_fraction=1 / 9, halving_seed=2024, store=None, study_name="default"):
+        if scoring not in scoring_modes:
+            raise ValueError(f"invalid scoring, valid options are {', '.join(scoring_modes)}")
         self.data = data
         self.results = []
         self.best_params = None
         self.best_score = None
+        self.umap_params = {'min_dist': 0.0, 'n_components': 3, 'random_state': 2024}
+        self.fingerprint = data_fingerprint(data)
+        self.cache = EmbeddingCache(cache_size, spill_dir)
+        # With share_knn one k-NN search with the largest n_neighbors is sliced for every trial,
+        # the embeddings then differ slightly from a fit from scratch
+        self.share_knn = share_knn
+        self.knn = None
+        # silhouette on the data, sampled silhouette, silhouette on the embedding or approximate DBCV
+        self.scoring = scoring
+        self.sample_size = sample_size
+        self.scoring_seed = scoring_seed
+        self.working_memory = working_memory
+        # Successive halving scores every trial on nested subsamples of 1/eta^k of the rows and
+        # only continues while it stays in the top 1/eta of the scores seen at that fraction
+        self.prune_infeasible = prune_infeasible
+        self.halving = halving
+        self.eta = eta
+        self.min_fraction = min_fraction
+        self.halving_seed = halving_seed
+        self.row_order = np.random.default_rng(halving_seed).permutation(data.shape[0])
+        self.rung_scores = {}
+        # Every finished trial is checkpointed to the study store (a StudyStore or a path)
+        self.store = StudyStore(store) if isinstance(store, (str, Path)) else store
+        self.study_name = study_name
+        if self.store is not None:
+            self.store.create_study(study_name, self.fingerprint, scoring)
+
+    def shared_knn(self):
+        if self.knn is None:
+            max_neighbors = min(50, self.data.shape[0] - 1)
+            self.knn = nearest_neighbors(self.data, max_neighbors, "euclidean", {}, False,
+                                         np.random.RandomState(self.umap_params['random_state']))
+        return self.knn
+
+    def rows(self, fraction):
+        # Nested subsamples taken from one permutation, None for the full data
+        if fraction >= 1.0:
+            return None
+        return np.sort(self.row_order[:max(2, int(round(len(self.row_order) * fraction)))])
+
+    def subset(self, rows):
+        if rows is None:
+            return self.data
+        return self.data.iloc[rows] if hasattr(self.data, "iloc") else self.data[rows]
+
+    def rung_fractions(self):
+        # e.g. 1/9, 1/3 and 1 with eta=3
+        fractions = [1.0]
+        while self.halving and fractions[0] / self.eta >= self.min_fraction:
+            fractions.insert(0, fractions[0] / self.eta)
+        return fractions
+
+    def feasible(self, n_rows, n_neighbors, min_samples, min_cluster_size):
+        # Two clusters need 2 * min_cluster_size points, UMAP and HDBSCAN need more rows than neighbours
+        return n_neighbors < n_rows and min_samples < n_rows and 2 * min_cluster_size <= n_rows
+
+    def promoted(self, score, history):
+        return len(history) < self.eta or score >= np.quantile(history, 1 - 1 / self.eta)
+
+    def embed(self, n_neighbors, require_model=False, rows=None):
+        # The embedding only depends on the data and the UMAP parameters, so it is fitted once
+        subsample = "all" if rows is None else f"{len(rows)}of{self.halving_seed}"
+        key = "_".join([self.fingerprint, subsample, str(n_neighbors), "knn" if self.share_knn else "full"]
+                       + [str(value) for value in self.umap_params.values()])
+        cached = self.cache.get(key)
+        if cached is not None and (cached[1] is not None or not require_model):
+            return cached
+
+        if self.share_knn and rows is None:
+            knn_indices, knn_dists, knn_search_index = self.shared_knn()
+            umap_model = umap.UMAP(n_neighbors=n_neighbors, **self.umap_params,
+                                   precomputed_knn=(knn_indices[:, :n_neighbors], knn_dists[:, :n_neighbors],
+                                                    knn_search_index))
+        else:
+            umap_model = umap.UMAP(n_neighbors=n_neighbors, **self.umap_params)
+        embedding = umap_model.fit_transform(self.subset(rows))
+        self.cache.put(key, embedding, umap_model)
+        return embedding, umap_model
     
-    def optimize(self, params):
-        n_neighbors = int(params['n_neighbors'])
-        min_samples = int(params['min_samples'])
-        min_cluster_size = int(params['min_cluster_size'])
-        
-        umap_model = umap.UMAP(n_neighbors=n_neighbors, min_dist=0.0, n_components=3, random_state=2024)
-        embedding = umap_model.fit_transform(self.data)
+    def score(self, n_neighbors, min_samples, min_cluster_size, rows=None):
+        embedding, _ = self.embed(n_neighbors, rows=rows)
         
         clusterer = HDBSCAN(min_samples=min_samples, min_cluster_size=min_cluster_size)
         labels = clusterer.fit_predict(embedding)
         
         if len(np.unique(labels)) <= 1:
-            score = 0  # All points are considered noise
-        else:
-            score = silhouette_score(self.data, labels)
+            return 0  # All points are considered noise
+        return score_clustering(self.subset(rows), embedding, labels, clusterer, self.scoring, self.sample_size,
+                                self.scoring_seed, self.working_memory)
+
+    @profiled("UMAPHDBSCANOptimizer.evaluate")
+    def evaluate(self, params, rung_scores=None):
+        n_neighbors = int(params['n_neighbors'])
+        min_samples = int(params['min_samples'])
+        min_cluster_size = int(params['min_cluster_size'])
+        rung_scores = self.rung_scores if rung_scores is None else rung_scores
+
+        # Returns the record, the score and the (fraction, score) of every rung reached
+        rungs = []
+        for fraction in self.rung_fractions():
+            rows = self.rows(fraction)
+            n_rows = self.data.shape[0] if rows is None else len(rows)
+            if not self.feasible(n_rows, n_neighbors, min_samples, min_cluster_size):
+                # Too few rows in the subsample, go straight to the next one
+                if fraction < 1.0:
+                    continue
+                # Rejected without fitting, these end as noise or a single cluster
+                if self.prune_infeasible:
+                    return (n_neighbors, min_samples, min_cluster_size, 0, "rejected", 0.0), 0, rungs
+            score = self.score(n_neighbors, min_samples, min_cluster_size, rows)
+            rungs.append((fraction, score))
+            if fraction < 1.0 and not self.promoted(score, rung_scores.get(fraction, [])):
+                break
         
+        return (n_neighbors, min_samples, min_cluster_size, score, self.scoring, fraction), score, rungs
+
+    def add_rungs(self, rungs):
+        for fraction, score in rungs:
+            self.rung_scores.setdefault(fraction, []).append(score)
+
+    def record_trial(self, params, record, score, rungs):
         # Record the parameters and their corresponding score
-        self.results.append((n_neighbors, min_samples, min_cluster_size, score))
+        self.results.append(record)
+        self.add_rungs(rungs)
+        if self.store is not None:
+            self.store.add_trial(self.study_name, self.fingerprint, len(self.results) - 1, params, record,
+                                 trial_result(record, score)['loss'], rungs)
+
+    def load_study(self, warm_start=False):
+        # Finished trials of this study to resume it and, with warm_start, the trials of the other
+        # studies on the same data and scoring as extra TPE history. Returns the trials and the
+        # number of warm start trials
+        trials = Trials()
+        if self.store is None:
+            return trials, 0
+        previous = []
+        if warm_start:
+            previous = self.store.trials(fingerprint=self.fingerprint, scoring=self.scoring, exclude=self.study_name)
+        current = self.store.trials(self.study_name, self.fingerprint)
+        insert_trials(trials, previous)
+        insert_trials(trials, current)
+        self.results = [trial['record'] for trial in current]
+        self.rung_scores = {}
+        for trial in previous + current:
+            self.add_rungs(trial['rungs'])
+        return trials, len(previous)
+
+    def optimize(self, params):
+        record, score, rungs = self.evaluate(params)
+        self.record_trial(params, record, score, rungs)
         
-        return {'loss': -score, 'status': STATUS_OK}
+        return trial_result(record, score)
     
-    def run_optimization(self, max_evals=100):
-        search_space = {
+    def search_space(self):
+        return {
             'n_neighbors': hp.quniform('n_neighbors', 2, 50, 1),
             'min_samples': hp.quniform('min_samples', 2, 50, 1),
             'min_cluster_size': hp.quniform('min_cluster_size', 2, 50, 1)
         }
+
+    def run_optimization(self, max_evals=100, n_jobs=1, seed=2024, patience=None, time_budget=None,
+                         warm_start=False):
+        # Stops early when the best score has not improved in patience trials or after
+        # time_budget seconds. With a store, a study stops at max_evals trials in total
+        # including the ones of earlier runs
+        if n_jobs != 1:
+            return self.run_parallel_optimization(max_evals, n_jobs, seed, patience, time_budget, warm_start)
         
-        trials = Trials()
-        self.best_params = fmin(
+        trials, n_warm = self.load_study(warm_start)
+        fmin(
             fn=self.optimize,
-            space=search_space,
+            space=self.search_space(),
             algo=tpe.suggest,
-            max_evals=max_evals,
-            trials=trials
+            max_evals=max_evals + n_warm,
+            trials=trials,
+            timeout=time_budget,
+            early_stop_fn=(lambda trials: (plateau_reached(trials, patience), [])) if patience else None
         )
         
-        self.best_score = -min(trial['result']['loss'] for trial in trials.trials)
+        # Warm start trials are only TPE history, the best comes from this study
+        self.best_params, self.best_score = best_trial(trials, n_warm)
         return self.best_params, self.best_score, self.results
 
-    def save_models(self, pipeline_name):
-        umap_model = umap.UMAP(n_neighbors=int(self.best_params["n_neighbors"]), min_dist=0.0, n_components=3, random_state=2024)
-        embedding = umap_model.fit_transform(self.data)
-        umap_filename = f'./models/trained_models/umap_{pipeline_name}.sav'
+    def run_parallel_optimization(self, max_evals=100, n_jobs=None, seed=2024, patience=None, time_budget=None,
+                                  warm_start=False):
+        # TPE suggests a batch of n_jobs candidates from the finished trials, the batch is
+        # evaluated in a process pool and its results are added in trial id order
+        domain = base.Domain(self.optimize, self.search_space())
+        trials, n_warm = self.load_study(warm_start)
+        max_evals += n_warm
+        rstate = np.random.default_rng(seed)
+        start = time.perf_counter()
+
+        n_jobs = n_jobs or os.cpu_count() or 1
+        # Computed once here so every worker starts with the shared k-NN graph
+        if self.share_knn:
+            self.shared_knn()
+        # Workers come from a forkserver when numba threads run here, e.g. after the k-NN search
+        # or an earlier sequential search, forking would hang the interpreter at exit
+        mp_context = multiprocessing.get_context("forkserver") if numba_threads_started() else None
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context, initializer=_init_worker,
+                                 initargs=(self,)) as executor:
+            while len(trials.trials) < max_evals and not plateau_reached(trials, patience):
+                if time_budget is not None and time.perf_counter() - start >= time_budget:
+                    break
+                new_trials, params = suggest_batch(domain, trials, min(n_jobs, max_evals - len(trials.trials)), rstate)
+
+                # Workers see the rung scores of the previous batches
+                results = executor.map(_evaluate, params, repeat(self.rung_scores))
+                for trial, spec, (record, score, rungs) in zip(new_trials, params, results):
+                    self.record_trial(spec, record, score, rungs)
+                    trial['state'] = base.JOB_STATE_DONE
+                    trial['result'] = trial_result(record, score)
+                trials.insert_trial_docs(new_trials)
+                trials.refresh()
+
+        self.best_params, self.best_score = best_trial(trials, n_warm)
+        return self.best_params, self.best_score, self.results
+
+    def save_models(self, pipeline_name, directory="./models/trained_models"):
+        # Reuse the model fitted during the search when it is still cached
+        embedding, umap_model = self.embed(int(self.best_params["n_neighbors"]), require_model=True)
+        umap_filename = f'{directory}/umap_{pipeline_name}.sav'
         joblib.dump(umap_model, umap_filename)
 
         clusterer = HDBSCAN(min_samples=int(self.best_params["min_samples"]), 
                                     min_cluster_size=int(self.best_params["min_cluster_size"]))
         labels = clusterer.fit_predict(embedding)
-        hdbscan_filename = f'./models/trained_models/hdbscan_{pipeline_name}.sav'
+        hdbscan_filename = f'{directory}/hdbscan_{pipeline_name}.sav'
         joblib.dump(clusterer, hdbscan_filename)
-        print("Saved models in ./models/trained_models")
+        print(f"Saved models in {directory}")
         
         return embedding, labels
+
+
+# Search spaces of the modelling notebooks, integer parameters are rounded by make_model
+classifier_spaces = {
+    "xgboost": {
+        'n_estimators': hp.quniform('n_estimators', 50, 300, 50),
+        'max_depth': hp.quniform('max_depth', 3, 6, 1),
+        'learning_rate': hp.loguniform('learning_rate', -2.5, -0.693),
+        'subsample': hp.uniform('subsample', 0.7, 1.0),
+        'colsample_bytree': hp.uniform('colsample_bytree', 0.7, 1.0),
+        'gamma': hp.uniform('gamma', 0, 5),
+        'reg_alpha': hp.loguniform('reg_alpha', -3, 1.5),
+        'reg_lambda': hp.loguniform('reg_lambda', -3, 1.5),
+    },
+    "random_forest": {
+        'n_estimators': hp.quniform('n_estimators', 50, 300, 10),
+        'max_depth': hp.quniform('max_depth', 3, 15, 1),
+        'min_samples_leaf': hp.quniform('min_samples_leaf', 1, 5, 1),
+        'bootstrap': hp.choice('bootstrap', [True, False]),
+    },
+    "svc": hp.choice('kernel', [
+        {'kernel': 'linear', 'C': hp.loguniform('C_linear', np.log(1e-5), np.log(1e2))},
+        {'kernel': 'rbf', 'C': hp.loguniform('C_rbf', np.log(1e-5), np.log(1e2)),
+         'gamma': hp.loguniform('gamma_rbf', np.log(1e-5), np.log(1e-1))},
+        {'kernel': 'sigmoid', 'C': hp.loguniform('C_sigmoid', np.log(1e-5), np.log(1e2)),
+         'gamma': hp.loguniform('gamma_sigmoid', np.log(1e-5), np.log(1e-1))},
+        {'kernel': 'poly', 'C': hp.loguniform('C_poly', np.log(1e-5), np.log(1e2)),
+         'gamma': hp.loguniform('gamma_poly', np.log(1e-5), np.log(1e-1)),
+         'degree': hp.quniform('degree', 2, 5, 1)},
+    ]),
+}
+
+
+def default_preprocessor(model, X):
+    """
+    Preprocessing of the notebooks for each model, fitted on the training rows of every fold.
+    Args:
+        model (str): "xgboost", "random_forest" or "svc".
+        X (DataFrame): Features, categorical columns as category or object.
+    Returns:
+        Transformer: Unfitted transformer, None for XGBoost which reads the category codes natively.
+    """
+    if model == "xgboost":
+        return None
+    categorical = [col for col in X.columns if isinstance(X[col].dtype, pd.CategoricalDtype) or X[col].dtype == object]
+    numeric = [col for col in X.columns if col not in categorical]
+    if model == "random_forest":
+        return ColumnTransformer([("categorical", OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=-1),
+                                   categorical)], remainder="passthrough")
+    # SVC: target encoding of the high cardinality columns, one-hot of the others and scaling
+    high = [col for col in categorical if X[col].nunique() > 10]
+    low = [col for col in categorical if col not in high]
+    return ColumnTransformer([
+        ("numerical", MinMaxScaler(), numeric),
+        ("high_cardinality", TargetEncoder(random_state=42), high),
+        ("low_cardinality", OneHotEncoder(handle_unknown="ignore", sparse_output=False), low),
+    ])
+
+
+class PreprocessingCache:
+    """
+    Transformed training and test rows of every cross-validation fold. The transformer is fitted
+    once per fold on its training rows and the matrices are reused by every trial of a search.
+    With a validation fraction the training rows of each fold are also split once into fit and
+    validation rows, used for the early stopping of the boosting rounds.
+    """
+
+    def __init__(self, X, y, preprocessor=None, n_splits=10, n_repeats=1, random_state=42,
+                 validation_fraction=None):
+        self.X = X
+        self.y = np.asarray(y)
+        self.preprocessor = preprocessor
+        self.validation_fraction = validation_fraction
+        self.random_state = random_state
+        cv = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state)
+        self.splits = list(cv.split(np.zeros(len(self.y)), self.y))
+        # Without a transformer the features are encoded once for every fold, see encode_features
+        self.features, self.feature_types = encode_features(X) if preprocessor is None else (None, None)
+        self.folds = {}
+
+    def transform(self, train, test):
+        if self.preprocessor is None:
+            return self.features[train], self.features[test]
+        preprocessor = clone(self.preprocessor)
+        rows = self.X.iloc if hasattr(self.X, "iloc") else self.X
+        return preprocessor.fit_transform(rows[train], self.y[train]), preprocessor.transform(rows[test])
+
+    def fold(self, i):
+        """
+        Matrices of one fold, computed on first use.
+        Args:
+            i (int): Index of the fold in self.splits.
+        Returns:
+            dict: X_fit, y_fit, X_val, y_val (None without validation_fraction), X_test, y_test.
+        """
+        if i not in self.folds:
+            train, test = self.splits[i]
+            X_train, X_test = self.transform(train, test)
+            fold = {"X_fit": X_train, "y_fit": self.y[train], "X_val": None, "y_val": None,
+                    "X_test": X_test, "y_test": self.y[test]}
+            if self.validation_fraction:
+                fit, val = train_test_split(np.arange(len(train)), test_size=self.validation_fraction,
+                                            stratify=self.y[train], random_state=self.random_state)
+                fold.update(X_fit=X_train[fit], y_fit=self.y[train][fit], X_val=X_train[val], y_val=self.y[train][val])
+            self.folds[i] = fold
+        return self.folds[i]
+
+    def fill(self):
+        # Every fold up front, e.g. before the cache is copied to the workers of a parallel search
+        for i in range(len(self.splits)):
+            self.fold(i)
+        return self
+
+
+def _init_classifier_worker(optimizer, threads):
+    global _worker_optimizer
+    _worker_optimizer = optimizer
+    _worker_optimizer.n_threads = threads
+    # Processes x threads per process stays within the cores
+    threadpool_limits(threads)
+
+
+def _evaluate_classifier(params):
+    return _worker_optimizer.evaluate(params)
+
+
+class ClassifierOptimizer:
+    """
+    Hyperopt search of the XGBoost, RandomForest and SVC hyperparameters of the modelling notebooks.
+    Trials are scored by the mean F1 over stratified folds whose preprocessing comes from a
+    PreprocessingCache, so scaling and encoding are fitted once per fold for the whole search.
+    XGBoost trials can stop adding boosting rounds once the validation AUC stops improving.
+    """
+
+    def __init__(self, X, y, model="xgboost", preprocessor="default", search_space=None, n_splits=10, n_repeats=1,
+                 random_state=42, early_stopping_rounds=None, validation_fraction=0.1, n_threads=None):
+        if model not in classifier_spaces:
+            raise ValueError(f"invalid model, valid options are {', '.join(classifier_spaces)}")
+        self.model = model
+        if isinstance(preprocessor, str) and preprocessor == "default":
+            preprocessor = default_preprocessor(model, X)
+        # Early stopping only applies to the boosting rounds of XGBoost
+        self.early_stopping_rounds = early_stopping_rounds if model == "xgboost" else None
+        self.cache = PreprocessingCache(X, y, preprocessor, n_splits, n_repeats, random_state,
+                                        validation_fraction if self.early_stopping_rounds else None)
+        self.space = search_space or classifier_spaces[model]
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.results = []
+        self.best_params = None
+        self.best_score = None
+
+    @profiled("ClassifierOptimizer.evaluate")
+    def evaluate(self, params):
+        """
+        Mean F1 of one set of hyperparameters over the folds.
+        Args:
+            params (dict): Hyperparameters, as sampled from the search space.
+        Returns:
+            dict: Parameters, mean and standard deviation of the F1 and the boosting rounds used.
+        """
+        if self.early_stopping_rounds:
+            params = {**params, "early_stopping_rounds": self.early_stopping_rounds}
+        scores, rounds = [], []
+        start = time.perf_counter()
+        for i in range(len(self.cache.splits)):
+            fold = self.cache.fold(i)
+            estimator = make_model(self.model, params, self.n_threads, self.cache.feature_types)
+            if self.early_stopping_rounds:
+                estimator.fit(fold["X_fit"], fold["y_fit"], eval_set=[(fold["X_val"], fold["y_val"])], verbose=False)
+                rounds.append(estimator.best_iteration + 1)
+            else:
+                estimator.fit(fold["X_fit"], fold["y_fit"])
+            scores.append(f1_score(fold["y_test"], estimator.predict(fold["X_test"])))
+        return {"params": params, "score": float(np.mean(scores)), "std": float(np.std(scores)),
+                "rounds": rounds, "seconds": time.perf_counter() - start}
+
+    def optimize(self, params):
+        result = self.evaluate(params)
+        self.results.append(result)
+        return {'loss': -result["score"], 'status': STATUS_OK}
+
+    def run_optimization(self, max_evals=50, n_jobs=1, seed=2024, patience=None, time_budget=None):
+        # Same stopping rules as UMAPHDBSCANOptimizer.run_optimization, returns the sampled values
+        # of the best trial (e.g. hp.choice indexes), see best_hyperparameters for the model ones
+        if n_jobs != 1:
+            return self.run_parallel_optimization(max_evals, n_jobs, seed, patience, time_budget)
+
+        trials = Trials()
+        self.best_params = fmin(
+            fn=self.optimize,
+            space=self.space,
+            algo=tpe.suggest,
+            max_evals=max_evals,
+            trials=trials,
+            rstate=np.random.default_rng(seed),
+            timeout=time_budget,
+            early_stop_fn=(lambda trials: (plateau_reached(trials, patience), [])) if patience else None
+        )
+        self.best_score = -min(trial['result']['loss'] for trial in trials.trials)
+        return self.best_params, self.best_score, self.results
+
+    def run_parallel_optimization(self, max_evals=50, n_jobs=None, seed=2024, patience=None, time_budget=None):
+        # Batches of n_jobs TPE suggestions evaluated in a process pool like
+        # UMAPHDBSCANOptimizer.run_parallel_optimization, the workers get the filled cache
+        domain = base.Domain(self.optimize, self.space)
+        trials = Trials()
+        rstate = np.random.default_rng(seed)
+        start = time.perf_counter()
+
+        n_jobs = n_jobs or os.cpu_count() or 1
+        self.cache.fill()
+        threads = max(1, self.n_threads // n_jobs)
+        # Always from a forkserver: unlike numba, the OpenMP and BLAS pools of XGBoost and scikit-learn
+        # cannot be checked, and a fork after fit_best or a sequential search could deadlock the workers
+        mp_context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context, initializer=_init_classifier_worker,
+                                 initargs=(self, threads)) as executor:
+            while len(trials.trials) < max_evals and not plateau_reached(trials, patience):
+                if time_budget is not None and time.perf_counter() - start >= time_budget:
+                    break
+                new_trials, params = suggest_batch(domain, trials, min(n_jobs, max_evals - len(trials.trials)), rstate)
+                # Sampled values to hyperparameters, e.g. hp.choice indexes to their options, like fmin does
+                params = [space_eval(self.space, spec) for spec in params]
+                for trial, result in zip(new_trials, executor.map(_evaluate_classifier, params)):
+                    self.results.append(result)
+                    trial['state'] = base.JOB_STATE_DONE
+                    trial['result'] = {'loss': -result["score"], 'status': STATUS_OK}
+                trials.insert_trial_docs(new_trials)
+                trials.refresh()
+
+        self.best_params = trials.argmin
+        self.best_score = -min(trial['result']['loss'] for trial in trials.trials)
+        return self.best_params, self.best_score, self.results
+
+    def best_hyperparameters(self):
+        # Model hyperparameters of the best trial, e.g. the kernel name instead of its hp.choice index
+        params = space_eval(self.space, self.best_params)
+        best = max(self.results, key=lambda result: result["score"])
+        if best["rounds"]:
+            # Boosting rounds actually used, averaged over the folds
+            params = {**params, "n_estimators": int(round(np.mean(best["rounds"])))}
+        return params
+
+    def fit_best(self):
+        """
+        Fit the preprocessing and the model with the best hyperparameters on every row.
+        Returns:
+            Estimator: A pipeline, or the XGBoost model that reads pandas categoricals directly.
+        """
+        params = self.best_hyperparameters()
+        X, y = self.cache.X, self.cache.y
+        if self.cache.preprocessor is None:
+            model = make_model(self.model, params, self.n_threads)
+            if self.model == "xgboost" and hasattr(X, "dtypes"):
+                # Same codes as encode_features
+                X = X.astype({col: "category" for col in X.columns if X[col].dtype == object})
+                model.set_params(enable_categorical=True)
+            return model.fit(X, y)
+        return make_pipeline(clone(self.cache.preprocessor), make_model(self.model, params, self.n_threads)).fit(X, y)
         
 # Example usage:
 # optimizer = UMAPHDBSCANOptimizer(umap_df)
 # best_params, best_score = optimizer.run_optimization(max_evals=100)
+# parallel search over 8 processes:
+# best_params, best_score, results = optimizer.run_optimization(max_evals=100, n_jobs=8)
+# stratified silhouette on 5000 points instead of the full O(n^2) score:
+# optimizer = UMAPHDBSCANOptimizer(umap_df, scoring="sampled", sample_size=5000)
+# stop after 20 trials without improvement, successive halving on 1/9 and 1/3 of the rows first:
+# optimizer = UMAPHDBSCANOptimizer(umap_df, halving=True)
+# best_params, best_score, results = optimizer.run_optimization(max_evals=200, patience=20, time_budget=3600)
+# resumable study checkpointed to SQLite, warm started from earlier studies on the same data:
+# optimizer = UMAPHDBSCANOptimizer(umap_df, store="models/studies.sqlite", study_name="run_2")
+# best_params, best_score, results = optimizer.run_optimization(max_evals=100, warm_start=True)
+# plot_hypersurface(StudyStore("models/studies.sqlite").results("run_2"), "run_2")
 # pipeline_name = "example_pipeline"
-# umap_filename, hdbscan_filename = optimizer.save_models(pipeline_name)
\ No newline at end of file
+# umap_filename, hdbscan_filename = optimizer.save_models(pipeline_name)
+# XGBoost tuning with the preprocessing fitted once per fold, 4 trials at a time and early stopping:
+# tuner = ClassifierOptimizer(X_train, y_train, model="xgboost", early_stopping_rounds=20)
+# best_params, best_score, results = tuner.run_optimization(max_evals=50, n_jobs=4)
+# joblib.dump(tuner.fit_best(), "./models/trained_models/xgb_m1_opt_balanced.sav")
\ No newline at end of file
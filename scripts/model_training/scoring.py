@@ -0,0 +1,103 @@
+import numpy as np
+import sklearn
+from sklearn import config_context
+from sklearn.metrics import silhouette_score
+
+# Scoring modes accepted by UMAPHDBSCANOptimizer, dbcv_approx is an approximation of DBCV
+scoring_modes = ["silhouette", "sampled", "embedding", "dbcv_approx"]
+
+# Fields of the private single linkage tree of sklearn.cluster.HDBSCAN read by relative_validity,
+# as in the tested scikit-learn 1.5.0
+single_linkage_fields = ("left_node", "right_node", "value", "cluster_size")
+
+
+def silhouette_exact(data, labels, working_memory=None):
+
+    # Exact silhouette, the distance matrix is reduced in chunks of at most working_memory MiB
+    with config_context(working_memory=working_memory):
+        return float(silhouette_score(data, labels))
+
+
+def stratified_sample(labels, sample_size, seed=2024):
+
+    # Indices of a sample where every label keeps its share of the points and at least one point
+    rng = np.random.default_rng(seed)
+    uniques, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    sizes = np.minimum(counts, np.maximum(1, np.round(sample_size * counts / len(labels)).astype(np.int64)))
+    order = np.argsort(inverse, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return np.sort(np.concatenate([rng.choice(order[start:start + count], size, replace=False)
+                                   for start, count, size in zip(starts, counts, sizes)]))
+
+
+def silhouette_sampled(data, labels, sample_size=2000, seed=2024, working_memory=None):
+
+    # Silhouette on a stratified sample, exact when the data is not larger than the sample
+    labels = np.asarray(labels)
+    if len(labels) <= sample_size:
+        return silhouette_exact(data, labels, working_memory)
+    idx = stratified_sample(labels, sample_size, seed)
+    if len(np.unique(labels[idx])) >= len(idx):
+        return 0.0
+    sample = data.iloc[idx] if hasattr(data, "iloc") else data[idx]
+    return silhouette_exact(sample, labels[idx], working_memory)
+
+
+def single_linkage_tree(clusterer):
+
+    # The tree is not part of the public API of HDBSCAN, fail clearly instead of scoring garbage
+    tree = getattr(clusterer, "_single_linkage_tree_", None)
+    if tree is None or getattr(tree.dtype, "names", None) != single_linkage_fields:
+        raise RuntimeError(f"scoring='dbcv_approx' reads the private single linkage tree of sklearn.cluster.HDBSCAN "
+                           f"(tested with scikit-learn 1.5.0), scikit-learn {sklearn.__version__} does not "
+                           f"provide it in that form, use another scoring mode")
+    return tree
+
+
+def relative_validity(clusterer):
+
+    # Approximation of DBCV, not the exact index, from the single linkage tree of a fitted sklearn
+    # HDBSCAN like the relative_validity_ of the hdbscan package. Merges inside one cluster give its
+    # density sparseness, the first merge between two clusters gives their density separation
+    labels = clusterer.labels_
+    clusters = np.unique(labels[labels >= 0])
+    if len(clusters) < 2:
+        return 0.0
+
+    n = len(labels)
+    sparseness = np.zeros(labels.max() + 1)
+    separation = np.full((labels.max() + 1, labels.max() + 1), np.inf)
+    members = {}
+    for k, (left, right, distance, _) in enumerate(single_linkage_tree(clusterer)):
+        left_labels = members.pop(left) if left >= n else ({labels[left]} if labels[left] >= 0 else set())
+        right_labels = members.pop(right) if right >= n else ({labels[right]} if labels[right] >= 0 else set())
+        if left_labels and right_labels:
+            if left_labels == right_labels and len(left_labels) == 1:
+                label = next(iter(left_labels))
+                sparseness[label] = max(sparseness[label], distance)
+            for a in left_labels - right_labels:
+                for b in right_labels - left_labels:
+                    separation[a, b] = separation[b, a] = min(separation[a, b], distance)
+        members[n + k] = left_labels | right_labels
+
+    score = 0.0
+    for label in clusters:
+        min_separation = separation[label].min()
+        denominator = max(min_separation, sparseness[label])
+        if np.isfinite(min_separation) and denominator > 0:
+            score += (labels == label).sum() / n * (min_separation - sparseness[label]) / denominator
+    return float(score)
+
+
+def score_clustering(data, embedding, labels, clusterer, scoring="silhouette", sample_size=2000, seed=2024,
+                     working_memory=None):
+
+    if scoring == "silhouette":
+        return silhouette_exact(data, labels, working_memory)
+    if scoring == "sampled":
+        return silhouette_sampled(data, labels, sample_size, seed, working_memory)
+    if scoring == "embedding":
+        return silhouette_exact(embedding, labels, working_memory)
+    if scoring == "dbcv_approx":
+        return relative_validity(clusterer)
+    raise ValueError(f"invalid scoring, valid options are {', '.join(scoring_modes)}")
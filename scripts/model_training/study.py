@@ -0,0 +1,117 @@
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from hyperopt import Trials, STATUS_OK
+from hyperopt import base
+import sqlite3
+import json
+
+default_store = Path("models/studies.sqlite")
+
+schema = """
+CREATE TABLE IF NOT EXISTS studies (
+    name TEXT, fingerprint TEXT, scoring TEXT, created TEXT,
+    PRIMARY KEY (name, fingerprint)
+);
+CREATE TABLE IF NOT EXISTS trials (
+    name TEXT, fingerprint TEXT, number INTEGER, params TEXT,
+    n_neighbors INTEGER, min_samples INTEGER, min_cluster_size INTEGER,
+    score REAL, mode TEXT, fraction REAL, loss REAL, rungs TEXT, created TEXT,
+    PRIMARY KEY (name, fingerprint, number)
+);
+"""
+
+
+class StudyStore:
+    """
+    SQLite store of UMAPHDBSCANOptimizer studies. A study is identified by its name and the
+    fingerprint of the data, every finished trial is written as one row so an interrupted
+    search can be resumed and later searches on the same data can be warm started.
+    Only the path is kept so the store can be sent to worker processes.
+    """
+
+    def __init__(self, path=default_store):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self.connect()) as conn, conn:
+            conn.executescript(schema)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create_study(self, name, fingerprint, scoring):
+        # Resuming a study is only allowed on the same data with the same scoring mode, otherwise
+        # trials scored differently would be compared
+        with closing(self.connect()) as conn, conn:
+            for stored_fingerprint, stored_scoring in conn.execute(
+                    "SELECT fingerprint, scoring FROM studies WHERE name = ?", (name,)).fetchall():
+                if (stored_fingerprint, stored_scoring) != (fingerprint, scoring):
+                    raise ValueError(f"study {name} exists with other data or scoring ({stored_scoring}), "
+                                     "use another study_name")
+            conn.execute("INSERT OR IGNORE INTO studies VALUES (?, ?, ?, ?)",
+                         (name, fingerprint, scoring, datetime.now().isoformat()))
+
+    def add_trial(self, name, fingerprint, number, params, record, loss, rungs):
+        n_neighbors, min_samples, min_cluster_size, score, mode, fraction = record
+        with closing(self.connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (name, fingerprint, number, json.dumps({k: float(v) for k, v in params.items()}),
+                          n_neighbors, min_samples, min_cluster_size, float(score), mode, float(fraction),
+                          float(loss), json.dumps([[float(f), float(s)] for f, s in rungs]),
+                          datetime.now().isoformat()))
+
+    def trials(self, name=None, fingerprint=None, scoring=None, exclude=None):
+        """
+        Stored trials as dictionaries in study and trial order.
+        Args:
+            name (str): Only this study.
+            fingerprint (str): Only studies on this data.
+            scoring (str): Only studies using this scoring mode.
+            exclude (str): Leave out the study with this name.
+        Returns:
+            list: One dictionary per trial with its params, record, loss and rungs.
+        """
+        query = ("SELECT t.name, t.number, t.params, t.n_neighbors, t.min_samples, t.min_cluster_size, "
+                 "t.score, t.mode, t.fraction, t.loss, t.rungs FROM trials t JOIN studies s "
+                 "ON t.name = s.name AND t.fingerprint = s.fingerprint WHERE 1 = 1")
+        args = []
+        for column, value in [("t.name", name), ("t.fingerprint", fingerprint), ("s.scoring", scoring)]:
+            if value is not None:
+                query += f" AND {column} = ?"
+                args.append(value)
+        if exclude is not None:
+            query += " AND t.name != ?"
+            args.append(exclude)
+        query += " ORDER BY s.created, t.name, t.number"
+        with closing(self.connect()) as conn:
+            rows = conn.execute(query, args).fetchall()
+        return [{"study": row[0], "number": row[1], "params": json.loads(row[2]), "record": tuple(row[3:9]),
+                 "loss": row[9], "rungs": [tuple(rung) for rung in json.loads(row[10])]} for row in rows]
+
+    def results(self, name=None, fingerprint=None):
+        # Records in the format of UMAPHDBSCANOptimizer.results, e.g. for plot_hypersurface
+        return [trial["record"] for trial in self.trials(name, fingerprint)]
+
+
+def insert_trials(trials, stored):
+
+    # Add stored trials to a hyperopt Trials object as finished trials so TPE uses them as history
+    if not stored:
+        return trials
+    tids = trials.new_trial_ids(len(stored))
+    specs = [None] * len(stored)
+    results = [{"loss": trial["loss"], "status": STATUS_OK, "score": trial["record"][3], "fraction": trial["record"][5]}
+               for trial in stored]
+    miscs = [{"tid": tid, "cmd": ("domain_attachment", "FMinIter_Domain"), "workdir": None,
+              "idxs": {k: [tid] for k in trial["params"]}, "vals": {k: [v] for k, v in trial["params"].items()}}
+             for tid, trial in zip(tids, stored)]
+    docs = trials.new_trial_docs(tids, specs, results, miscs)
+    for doc in docs:
+        doc["state"] = base.JOB_STATE_DONE
+    trials.insert_trial_docs(docs)
+    trials.refresh()
+    return trials
+
+
+def load_trials(stored):
+    return insert_trials(Trials(), stored)
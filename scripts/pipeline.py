@@ -0,0 +1,282 @@
+# Command line runner of the clustering and feature selection pipeline
+# Usage: python scripts/pipeline.py                      run every stage whose inputs changed
+#        python scripts/pipeline.py --targets merge     run merge and the stages it needs
+#        python scripts/pipeline.py --force clean_clinvar --jobs 3 --dry-run
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import hashlib
+import inspect
+import json
+import time
+import os
+
+import pandas as pd
+
+from data_processing.cleaner import cleaning, compare_and_drop_duplicates, wide_upgenevsrep
+from data_processing.layout import CategoryRegistry, fill_category
+from feature_selection.selector import mutual_information, select_vars
+from model_training.optimizer import UMAPHDBSCANOptimizer
+from model_training.scoring import score_clustering
+from model_training.study import StudyStore
+from evaluation.render import render_figures
+from helper import profiling
+from helper.loader import project_root, cache_dir, code_version, read_csv, file_hash, write_cached, read_cached
+
+# Raw inputs, relative to the project root, can be changed with --input name=path
+default_inputs = {
+    "clinvar": "data/raw/cancermama_clinvarmain.csv",
+    "variation": "data/raw/variation_information.tsv",
+    "upgenevsrep": "data/raw/UP.geneVsrepList",
+    "oncokb": "data/external/oncokb_classification.csv",
+}
+
+default_params = {
+    "max_evals": 100,
+    "optimizer_jobs": 1,
+    "association_threshold": 0.85,
+}
+
+# Columns the notebooks drop after merging, ids, urls and copies of other columns
+drop_after_merge = ["geneId", "_originCode", "_allTypeCode", "ClinInfo", "numSubmit", "_variantId", "origName",
+                    "rcvAcc", "snpId", "Start", "End", "phenotype", "_mouseOver", "reserved", "real_id"]
+
+# Category dictionaries shared by the stage processes, codes stay stable between runs
+registry_dir = project_root / "models" / "categories"
+# Study store of the clustering search, fitted models and the labels the notebooks read
+study_store = project_root / "models" / "studies.sqlite"
+models_dir = project_root / "models" / "trained_models"
+labels_path = project_root / "data" / "processed" / "labels.csv"
+
+
+def clean_clinvar(deps, config):
+    return cleaning(read_csv(config["inputs"]["clinvar"], sep="\t", low_memory=False), "cancermama_clinvarmain",
+                    registry=CategoryRegistry(registry_dir))
+
+
+def clean_variation(deps, config):
+    return cleaning(read_csv(config["inputs"]["variation"], sep="\t"), "variation_information",
+                    registry=CategoryRegistry(registry_dir))
+
+
+def clean_upgenevsrep(deps, config):
+    return cleaning(read_csv(config["inputs"]["upgenevsrep"], sep="\t", header=None), "UP.geneVsrepList")
+
+
+def wide_repeats(deps, config):
+    return wide_upgenevsrep(deps["clean_upgenevsrep"])
+
+
+def cluster_genes(deps, config):
+
+    # Search checkpointed in the study store under the stage key, so an interrupted run resumes
+    wide = deps["wide_repeats"]
+    optimizer = UMAPHDBSCANOptimizer(wide, store=StudyStore(study_store), study_name=f"pipeline_{config['key']}")
+    optimizer.run_optimization(max_evals=config["params"]["max_evals"], n_jobs=config["params"]["optimizer_jobs"])
+    models_dir.mkdir(parents=True, exist_ok=True)
+    embedding, labels = optimizer.save_models("pipeline", models_dir)
+    result = pd.DataFrame({"gen": wide.index.astype(str), "label": labels,
+                           "x": embedding[:, 0], "y": embedding[:, 1], "z": embedding[:, 2]})
+    # Same file the data_cleaning notebook reads
+    labels_path.parent.mkdir(parents=True, exist_ok=True)
+    result[["gen", "label"]].to_csv(labels_path, index=False)
+    return result
+
+
+def merge(deps, config):
+
+    # Join and tidy the cleaned tables like the data_cleaning notebook
+    var_info = deps["clean_variation"].copy()
+    cancer_clinvar = deps["clean_clinvar"].copy()
+    var_info["real_id"] = var_info["rsID"].astype(str) + " " + var_info["ClinInfo"].astype(str)
+    cancer_clinvar["real_id"] = cancer_clinvar["snpId"].astype(str) + " " + cancer_clinvar["ClinInfo"].astype(str)
+    cancer_clinvar = cancer_clinvar.drop(["ClinInfo"], axis=1)
+    merged_df = cancer_clinvar.merge(var_info, left_on="real_id", right_on="real_id")
+
+    merged_df = compare_and_drop_duplicates(merged_df)
+    merged_df["bin_class"] = merged_df["Classification"].apply(lambda x: 1 if x in ["pg"] else 0)
+    merged_df = merged_df.drop(columns=drop_after_merge, errors="ignore")
+    for col, value in [("clinSign", "unkwown"), ("ClinClass", "unkwown"), ("molConseq", "unkwown"),
+                       ("phenotypeList", "not provided")]:
+        if col in merged_df.columns:
+            merged_df[col] = fill_category(merged_df[col], value)
+
+    if (project_root / config["inputs"]["oncokb"]).exists():
+        oncokb_df = read_csv(config["inputs"]["oncokb"])
+        oncokb_df["gen"] = oncokb_df["gen"].str.lower()
+        merged_df = merged_df.merge(oncokb_df, left_on="Gene", right_on="gen", how="left")
+        merged_df = merged_df.drop(["gen", "description"], axis=1, errors="ignore")
+
+    labels = deps["cluster_genes"][["gen", "label"]].copy()
+    labels["gen"] = labels["gen"].str.lower()
+    merged_df = merged_df.merge(labels, left_on="Gene", right_on="gen")
+    merged_df = merged_df.rename(columns={"label": "gen_label"})
+    return merged_df.reset_index(drop=True)
+
+
+def select_features(deps, config):
+    merged_df = deps["merge"].copy()
+    merged_df["gen_label"] = merged_df["gen_label"].fillna(99)
+    return select_vars(mutual_information(merged_df), config["params"]["association_threshold"])
+
+
+def plots(deps, config):
+
+    # Figures are skipped by render_figures itself when their inputs did not change
+    clusters = deps["cluster_genes"]
+    results = StudyStore(study_store).results(f"pipeline_{config['deps']['cluster_genes']}")
+    rendered = render_figures([
+        ("hypersurface", {"results": results, "figname": "pipeline"}),
+        ("embedding", {"embedding": clusters[["x", "y", "z"]].to_numpy(), "labels": clusters["label"].to_numpy(),
+                       "filename": "upgenevsrep_embeddings_pipeline"}),
+    ], directory=project_root / "results" / "figures")
+    return pd.DataFrame({"figure": [path for paths in rendered.values() for path in paths]})
+
+
+# Stage graph: function, upstream stages, raw inputs, parameters and modules that enter the cache key,
+# e.g. data_processing.layout (downcast, category encoding) for the cleaned tables
+stages = {
+    "clean_clinvar": {"run": clean_clinvar, "deps": [], "inputs": ["clinvar"], "params": [],
+                      "code": [cleaning, CategoryRegistry]},
+    "clean_variation": {"run": clean_variation, "deps": [], "inputs": ["variation"], "params": [],
+                        "code": [cleaning, CategoryRegistry]},
+    "clean_upgenevsrep": {"run": clean_upgenevsrep, "deps": [], "inputs": ["upgenevsrep"], "params": [],
+                          "code": [cleaning, CategoryRegistry]},
+    "wide_repeats": {"run": wide_repeats, "deps": ["clean_upgenevsrep"], "inputs": [], "params": [],
+                     "code": [wide_upgenevsrep]},
+    # The parallel search suggests trials in batches of optimizer_jobs, which changes the trials
+    "cluster_genes": {"run": cluster_genes, "deps": ["wide_repeats"], "inputs": [],
+                      "params": ["max_evals", "optimizer_jobs"], "code": [UMAPHDBSCANOptimizer, score_clustering]},
+    "merge": {"run": merge, "deps": ["clean_clinvar", "clean_variation", "cluster_genes"], "inputs": ["oncokb"],
+              "params": [], "code": [compare_and_drop_duplicates, fill_category]},
+    "select_features": {"run": select_features, "deps": ["merge"], "inputs": [],
+                        "params": ["association_threshold"], "code": [mutual_information, select_vars]},
+    "plots": {"run": plots, "deps": ["cluster_genes"], "inputs": [], "params": [], "code": [render_figures]},
+}
+
+
+def required_stages(targets):
+
+    # Targets and everything upstream of them, in topological order
+    order = []
+
+    def visit(name):
+        if name not in stages:
+            raise ValueError(f"invalid stage {name}, valid options are {', '.join(stages)}")
+        for dep in stages[name]["deps"]:
+            visit(dep)
+        if name not in order:
+            order.append(name)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+def stage_key(name, keys, config):
+
+    # Hash of the raw input files, the keys of the upstream stages, the parameters and the code
+    stage = stages[name]
+    digest = hashlib.sha256(name.encode())
+    for item in stage["inputs"]:
+        path = config["inputs"][item]
+        digest.update((file_hash(path) if (project_root / path).exists() else "missing").encode())
+    digest.update(json.dumps([keys[dep] for dep in stage["deps"]]).encode())
+    digest.update(json.dumps({p: config["params"][p] for p in stage["params"]}, sort_keys=True).encode())
+    digest.update(inspect.getsource(stage["run"]).encode())
+    # Modules of the stage code and the project modules they import, plus helper.loader.cache_version
+    digest.update(code_version(stage["code"]).encode())
+    return digest.hexdigest()[:16]
+
+
+def output_path(name, key):
+    return project_root / cache_dir / f"{name}_{key}.arrow"
+
+
+def run_stage(name, keys, config):
+
+    # Runs in a worker process, upstream outputs are memory-mapped from the cache
+    stage = stages[name]
+    deps = {dep: read_cached(output_path(dep, keys[dep])) for dep in stage["deps"]}
+    stage_config = {**config, "key": keys[name], "deps": {dep: keys[dep] for dep in stage["deps"]}}
+    start = time.perf_counter()
+    result = stage["run"](deps, stage_config)
+    write_cached(result, output_path(name, keys[name]))
+    return time.perf_counter() - start
+
+
+def run_pipeline(targets=None, force=(), n_jobs=None, inputs=None, params=None, dry_run=False):
+    """
+    Run the stages needed for targets, skipping the ones whose cached output is up to date.
+    Args:
+        targets (list): Stages to produce, every stage by default.
+        force (list): Stages to run even when cached, "all" for every stage.
+        n_jobs (int): Number of stages run at the same time, independent branches run concurrently.
+        inputs (dict): Raw input paths overriding default_inputs.
+        params (dict): Parameters overriding default_params.
+        dry_run (bool): Only report which stages would run.
+    Returns:
+        dict: Status of each stage, "cached", "ran" or "pending" with dry_run.
+    """
+    config = {"inputs": {**default_inputs, **(inputs or {})}, "params": {**default_params, **(params or {})}}
+    order = required_stages(targets or list(stages))
+    keys = {}
+    for name in order:
+        keys[name] = stage_key(name, keys, config)
+
+    # A stage reruns when forced, not cached or downstream of a stage that reruns
+    pending = []
+    for name in order:
+        stale = "all" in force or name in force or not output_path(name, keys[name]).exists()
+        if stale or any(dep in pending for dep in stages[name]["deps"]):
+            pending.append(name)
+    status = {name: "cached" for name in order if name not in pending}
+    for name in status:
+        print(f"{name:<18} cached ({keys[name]})")
+    if dry_run:
+        for name in pending:
+            print(f"{name:<18} would run ({keys[name]})")
+        return {**status, **{name: "pending" for name in pending}}
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while pending or running:
+            # Submit every stage whose upstream stages are done
+            for name in [name for name in pending if all(dep in status for dep in stages[name]["deps"])]:
+                if len(running) < n_jobs:
+                    pending.remove(name)
+                    running[executor.submit(run_stage, name, keys, config)] = name
+                    print(f"{name:<18} started")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                seconds = future.result()
+                status[name] = "ran"
+                print(f"{name:<18} done in {seconds:.1f} s ({keys[name]})")
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline stages whose inputs changed")
+    parser.add_argument("--targets", nargs="+", choices=list(stages), help="stages to produce, all by default")
+    parser.add_argument("--force", nargs="+", default=[], help="stages to rerun even when cached, or all")
+    parser.add_argument("--jobs", type=int, help="stages run at the same time")
+    parser.add_argument("--input", nargs="+", default=[], metavar="NAME=PATH",
+                        help=f"raw inputs relative to the project root: {', '.join(default_inputs)}")
+    parser.add_argument("--max-evals", type=int, default=default_params["max_evals"])
+    parser.add_argument("--optimizer-jobs", type=int, default=default_params["optimizer_jobs"])
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--profile", action="store_true", help="log every stage to results/logs/stages.jsonl")
+    args = parser.parse_args()
+
+    if args.profile:
+        # Through the environment so the stage processes log as well
+        os.environ["PIPELINE_PROFILING"] = "1"
+        profiling.configure(enable=True)
+
+    run_pipeline(args.targets, args.force, args.jobs, dict(item.split("=", 1) for item in args.input),
+                 {"max_evals": args.max_evals, "optimizer_jobs": args.optimizer_jobs}, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
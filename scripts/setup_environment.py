@@ -9,7 +9,8 @@ def setup_paths():
     # Always find the root relative to this script's location
     project_root = Path(__file__).resolve().parent.parent
 
-    # Add the scripts directory to the Python path
-    sys.path.append(str(project_root / "scripts"))
+    # Add the scripts directory to the Python path, only once when called again
+    if str(project_root / "scripts") not in sys.path:
+        sys.path.append(str(project_root / "scripts"))
 
     return project_root